@@ -1,95 +1,145 @@
-import os, json, psycopg
+import os, threading
+from datetime import datetime
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
 DATABASE_URL = os.getenv("DATABASE_URL", "").replace("DATABASE_URL=", "").strip("'\"")
 
+# Общий пул соединений на процесс вместо нового TCP+auth на каждый запрос.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# С какого повторения запрос готовится на сервере (server-side prepared statement).
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "2"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                kwargs={"row_factory": dict_row, "prepare_threshold": DB_PREPARE_THRESHOLD},
+                check=ConnectionPool.check_connection,
+                max_idle=300,
+                name="api",
+                open=True,
+            )
+        return _pool
+
+
+def pool_stats():
+    return get_pool().get_stats() if _pool is not None else {}
+
 
 def db_connect():
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    return get_pool().connection()
+
+
+# История статусов хранится в таблице operation_events; к строке документа она
+# приклеивается колонкой operation_events ([{"type", "date"}, ...] в порядке добавления).
+_EVENTS_COLUMN = (
+    "(SELECT COALESCE(jsonb_agg(jsonb_build_object('type', e.type, 'date', e.event_date) ORDER BY e.id), '[]'::jsonb) "
+    "FROM operation_events e WHERE e.doc_id = transport_documents.id) AS operation_events"
+)
 
 
 def get_doc(doc_id):
     with db_connect() as conn:
-        return conn.execute("SELECT * FROM transport_documents WHERE id=%s", (doc_id,)).fetchone()
+        return conn.execute(f"SELECT *, {_EVENTS_COLUMN} FROM transport_documents WHERE id=%s", (doc_id,)).fetchone()
+
+
+# Все правки ocr_data — один UPDATE с патчем JSONB на стороне сервера: без предварительного
+# чтения документа и без потери изменений при параллельных нажатиях. Возвращается обновлённая строка.
+FIELD_PATHS = {
+    "carrier_name": ("carrier_name", "value"),
+    "unloading_address": ("unloading_address", "value"),
+    "operation_type": ("operation_type", "value"),
+    "operation_date": ("operation_date", "value"),
+    "sender_address": ("sender_address", "value"),
+    "loading_date": ("loading_date", "value"),
+    "driver_name": ("driver_name", "value"),
+    "weight_kg": ("weight_total", "kg"),
+    "product_type": ("product_type", "value"),
+}
 
 
-def _save_ocr(doc_id, ocr):
+def _obj(key):
+    # Имена ключей берутся только из FIELD_PATHS/констант, поэтому подставляются в SQL напрямую.
+    return f"(CASE WHEN jsonb_typeof(ocr_data->'{key}') = 'object' THEN ocr_data->'{key}' ELSE '{{}}'::jsonb END)"
+
+
+def _set_value(key, sub, value_sql):
+    return f"'{key}', {_obj(key)} || jsonb_build_object('{sub}', {value_sql})"
+
+
+def _patch_ocr(doc_id, patch_sql, params=(), before=()):
+    # before — запросы к operation_events в той же транзакции; UPDATE уже видит их результат.
     with db_connect() as conn:
-        conn.execute(
-            "UPDATE transport_documents SET ocr_data=%s::jsonb, status='edited' WHERE id=%s",
-            (json.dumps(ocr, ensure_ascii=False), doc_id),
-        )
+        for sql, args in before:
+            conn.execute(sql, args)
+        row = conn.execute(
+            f"UPDATE transport_documents SET ocr_data = (COALESCE(ocr_data, '{{}}'::jsonb) - 'operation_events') || jsonb_build_object({patch_sql}), "
+            f"status='edited' WHERE id=%s RETURNING *, {_EVENTS_COLUMN}",
+            (*params, doc_id),
+        ).fetchone()
         conn.commit()
+        return row
+
+
+def parse_event_day(value):
+    """Дата статуса в виде date для индекса по дням; None, если водитель ввёл не ДД.ММ.ГГГГ."""
+    try:
+        return datetime.strptime((value or "").strip(), "%d.%m.%Y").date()
+    except ValueError:
+        return None
 
 
 def update_field(doc_id, field, value):
-    doc = get_doc(doc_id)
-    ocr = doc.get("ocr_data") or {}
-
-    if field == "carrier_name":
-        ocr.setdefault("carrier_name", {})["value"] = value
-    elif field == "unloading_address":
-        ocr.setdefault("unloading_address", {})["value"] = value
-    elif field == "operation_type":
-        ocr.setdefault("operation_type", {})["value"] = value
-    elif field == "operation_date":
-        ocr.setdefault("operation_date", {})["value"] = value
-    elif field == "sender_address":
-        ocr.setdefault("sender_address", {})["value"] = value
-    elif field == "loading_date":
-        ocr.setdefault("loading_date", {})["value"] = value
-    elif field == "driver_name":
-        ocr.setdefault("driver_name", {})["value"] = value
-    elif field == "weight_kg":
-        ocr.setdefault("weight_total", {})["kg"] = value
-    elif field == "product_type":
-        ocr.setdefault("product_type", {})["value"] = value
-
-    _save_ocr(doc_id, ocr)
-
-
-def add_operation_event(doc_id, op_type, op_date):
-    doc = get_doc(doc_id)
-    ocr = doc.get("ocr_data") or {}
-    events = ocr.get("operation_events")
-    if not isinstance(events, list):
-        events = []
-    events.append({"type": op_type, "date": op_date})
-    ocr["operation_events"] = events
-    ocr.setdefault("operation_type", {})["value"] = op_type
-    ocr.setdefault("operation_date", {})["value"] = op_date
-    _save_ocr(doc_id, ocr)
+    path = FIELD_PATHS.get(field)
+    if not path:
+        return get_doc(doc_id)
+    return _patch_ocr(doc_id, _set_value(path[0], path[1], "%s::text"), (value,))
+
+
+def add_operation_event(doc_id, op_type, op_date, actor=None):
+    insert = (
+        "INSERT INTO operation_events (doc_id, type, event_date, event_day, actor) VALUES (%s, %s, %s, %s, %s)",
+        (doc_id, op_type, op_date, parse_event_day(op_date), actor),
+    )
+    patch = ", ".join([
+        _set_value("operation_type", "value", "%s::text"),
+        _set_value("operation_date", "value", "%s::text"),
+    ])
+    return _patch_ocr(doc_id, patch, (op_type, op_date), before=[insert])
+
+
+_LAST_EVENT = "(SELECT {col} FROM operation_events WHERE doc_id = transport_documents.id ORDER BY id DESC LIMIT 1)"
 
 
 def remove_last_operation_event(doc_id):
-    doc = get_doc(doc_id)
-    ocr = doc.get("ocr_data") or {}
-    events = ocr.get("operation_events")
-    if not isinstance(events, list) or not events:
-        ocr.setdefault("operation_type", {})["value"] = None
-        ocr.setdefault("operation_date", {})["value"] = None
-        _save_ocr(doc_id, ocr)
-        return
-
-    events.pop()
-    ocr["operation_events"] = events
-    if events:
-        last = events[-1]
-        ocr.setdefault("operation_type", {})["value"] = last.get("type")
-        ocr.setdefault("operation_date", {})["value"] = last.get("date")
-    else:
-        ocr.setdefault("operation_type", {})["value"] = None
-        ocr.setdefault("operation_date", {})["value"] = None
-    _save_ocr(doc_id, ocr)
+    # Статус документа берём из нового последнего события (или NULL, если событий не осталось).
+    delete = (
+        "DELETE FROM operation_events WHERE id = (SELECT max(id) FROM operation_events WHERE doc_id=%s)",
+        (doc_id,),
+    )
+    patch = ", ".join([
+        _set_value("operation_type", "value", _LAST_EVENT.format(col="type")),
+        _set_value("operation_date", "value", _LAST_EVENT.format(col="event_date")),
+    ])
+    return _patch_ocr(doc_id, patch, before=[delete])
 
 
 def clear_operation_events(doc_id):
-    doc = get_doc(doc_id)
-    ocr = doc.get("ocr_data") or {}
-    ocr["operation_events"] = []
-    ocr.setdefault("operation_type", {})["value"] = None
-    ocr.setdefault("operation_date", {})["value"] = None
-    _save_ocr(doc_id, ocr)
+    patch = ", ".join([
+        _set_value("operation_type", "value", "NULL::jsonb"),
+        _set_value("operation_date", "value", "NULL::jsonb"),
+    ])
+    return _patch_ocr(doc_id, patch, before=[("DELETE FROM operation_events WHERE doc_id=%s", (doc_id,))])
 
 
 def set_status(doc_id, status):
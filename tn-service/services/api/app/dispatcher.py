@@ -0,0 +1,70 @@
+import queue, threading, time, zlib
+
+# Раздача апдейтов MAX по шардам: шард выбирается по chat_id, у каждого шарда свой поток.
+# Чаты обрабатываются параллельно, а апдейты одного чата — строго в порядке получения.
+LAG_WARN_SECONDS = 5.0
+
+
+class ShardedDispatcher:
+    def __init__(self, handler, shards: int, name: str = "dispatch"):
+        self.handler = handler
+        self.name = name
+        self.queues = [queue.Queue() for _ in range(max(1, shards))]
+        self.stats_lock = threading.Lock()
+        self.shard_stats = [{"processed": 0, "failed": 0, "lag_last": 0.0, "lag_max": 0.0, "busy_since": None} for _ in self.queues]
+        self.threads = []
+
+    def start(self):
+        for i in range(len(self.queues)):
+            t = threading.Thread(target=self._run, args=(i,), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def shard_for(self, chat_id) -> int:
+        # crc32, а не hash(): номер шарда не зависит от PYTHONHASHSEED.
+        return zlib.crc32(str(chat_id).encode("utf-8")) % len(self.queues)
+
+    def submit(self, chat_id, item):
+        self.queues[self.shard_for(chat_id)].put((time.monotonic(), item))
+
+    def _run(self, shard: int):
+        q, st = self.queues[shard], self.shard_stats[shard]
+        while True:
+            enqueued_at, item = q.get()
+            lag = time.monotonic() - enqueued_at
+            with self.stats_lock:
+                st["lag_last"] = lag
+                st["lag_max"] = max(st["lag_max"], lag)
+                st["busy_since"] = time.monotonic()
+            if lag > LAG_WARN_SECONDS:
+                print(f"🐢 [DISPATCH] Шард {shard}: апдейт ждал {lag:.1f}s, в очереди ещё {q.qsize()}", flush=True)
+            try:
+                self.handler(item)
+                failed = 0
+            except Exception as exc:
+                failed = 1
+                print(f"❌ Failed to process update: {exc}; update={item}", flush=True)
+            with self.stats_lock:
+                st["processed"] += 1
+                st["failed"] += failed
+                st["busy_since"] = None
+
+    def stats(self, reset_max: bool = True):
+        """Глубина очереди и задержка (ожидание до начала обработки) по каждому шарду; lag_max — с прошлого вызова."""
+        now = time.monotonic()
+        out = []
+        with self.stats_lock:
+            for i, (q, st) in enumerate(zip(self.queues, self.shard_stats)):
+                out.append({
+                    "shard": i,
+                    "depth": q.qsize(),
+                    "processed": st["processed"],
+                    "failed": st["failed"],
+                    "lag_last": round(st["lag_last"], 3),
+                    "lag_max": round(st["lag_max"], 3),
+                    "busy_for": round(now - st["busy_since"], 3) if st["busy_since"] else 0.0,
+                })
+                if reset_max:
+                    st["lag_max"] = 0.0
+        return {"depth": sum(s["depth"] for s in out), "shards": out}
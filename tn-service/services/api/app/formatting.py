@@ -29,8 +29,10 @@ def _status_label(op_type):
     return f"📝 {op_type}" if op_type and op_type != "—" else "—"
 
 
-def _format_statuses(data, fallback_date):
-    events = data.get("operation_events") if isinstance(data, dict) else None
+def _format_statuses(data, fallback_date, events=None):
+    # events — строки из таблицы operation_events; массив в ocr_data остался только у старых записей.
+    if events is None:
+        events = data.get("operation_events") if isinstance(data, dict) else None
     if isinstance(events, list) and events:
         chunks = []
         for e in events:
@@ -50,7 +52,7 @@ def _format_statuses(data, fallback_date):
     return f"{label} ({status_date})"
 
 
-def format_for_driver(doc_id: int, data: dict, ok: bool, reason: str, conf: float) -> str:
+def format_for_driver(doc_id: int, data: dict, ok: bool, reason: str, conf: float, events=None) -> str:
     addr = _g(data, "sender_address", "value")
     load_date = _g(data, "loading_date", "value")
     driver = _short_name(_g(data, "driver_name", "value"))
@@ -59,7 +61,7 @@ def format_for_driver(doc_id: int, data: dict, ok: bool, reason: str, conf: floa
     carrier = _g(data, "carrier_name", "value")
     unload = _g(data, "unloading_address", "value")
 
-    op_str = _format_statuses(data or {}, load_date if load_date != "—" else "—")
+    op_str = _format_statuses(data or {}, load_date if load_date != "—" else "—", events)
 
     lines = [f"📄 **Накладная #{doc_id}**", ""]
     lines.append(f"Грузоотправитель: {addr}")
@@ -1,9 +1,13 @@
 from fastapi import FastAPI
 import logging
-import json, redis, os, requests, threading, time
-from concurrent.futures import ThreadPoolExecutor
-from app.db import get_doc, update_field, add_operation_event, remove_last_operation_event, clear_operation_events
+import json, redis, os, threading, time
+from app.db import get_doc, update_field, add_operation_event, remove_last_operation_event, clear_operation_events, pool_stats
 from app.formatting import format_for_driver
+from app.task_queue import enqueue
+from app.migrations import check_schema
+from app.dispatcher import ShardedDispatcher
+from app import platform_http
+from app.platform_http import PlatformClient
 
 logging.basicConfig(level=logging.INFO)
 
@@ -13,11 +17,14 @@ rds = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"), decod
 MAX_API_URL = "https://platform-api.max.ru"
 MAX_TOKEN = os.getenv("MAX_BOT_TOKEN")
 HEADERS = {"Authorization": f"{MAX_TOKEN}"}
+# Общий keep-alive клиент к MAX: опрос, ответы и правки сообщений идут по одним соединениям.
+MAX = PlatformClient("max", MAX_API_URL, headers=HEADERS)
 EDIT_STATE = {}
 
 FILE_BUFFER = {}
 BUFFER_LOCK = threading.Lock()
-CALLBACK_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("MAX_CALLBACK_WORKERS", "8")))
+# Число шардов (потоков) обработки апдейтов; апдейты одного чата всегда попадают в один шард.
+MAX_DISPATCH_SHARDS = int(os.getenv("MAX_DISPATCH_SHARDS", os.getenv("MAX_CALLBACK_WORKERS", "8")))
 
 
 def flush_buffer(chat_id):
@@ -29,8 +36,9 @@ def flush_buffer(chat_id):
     if not files:
         return
     print(f"📦 [DEBUG] Буфер сброшен для {chat_id}. Файлов: {len(files)}", flush=True)
-    rds.rpush("tasks", json.dumps({"type": "batch", "platform": "max", "chat_id": str(chat_id), "files": files}))
-    send_max_message(chat_id, f"📥 Принято файлов: {len(files)}. Обрабатываю...")
+    # Сначала подтверждение: воркер будет редактировать это же сообщение (прогресс и итоговая карточка).
+    ack_mid = send_max_message(chat_id, f"📥 Принято файлов: {len(files)}. Обрабатываю...")
+    enqueue(rds, {"type": "batch", "platform": "max", "chat_id": str(chat_id), "files": files, "ack_mid": ack_mid})
 
 
 def add_to_buffer(chat_id, new_urls):
@@ -86,10 +94,10 @@ def send_max_message(chat_id, text, reply_markup=None):
         body["attachments"] = atts
     try:
         print(f"📤 [DEBUG] Отправка сообщения в {chat_id}: {text[:20]}...", flush=True)
-        resp = requests.post(f"{MAX_API_URL}/messages", params={"chat_id": chat_id}, json=body, headers=HEADERS, timeout=20)
-        if not resp.ok:
+        resp = MAX.post("/messages", params={"chat_id": chat_id}, json=body)
+        if not resp.is_success:
             print(f"❌ [DEBUG] Ошибка отправки MAX: {resp.status_code} {resp.text}", flush=True)
-        if resp.ok:
+        if resp.is_success:
             return _extract_mid(resp.json())
     except Exception as e:
         print(f"❌ [DEBUG] Исключение отправки MAX: {e}", flush=True)
@@ -105,8 +113,8 @@ def edit_max_message(mid, text, reply_markup=None):
     body["attachments"] = atts if atts else []
     try:
         print(f"📤 [DEBUG] Редактирование сообщения {mid}...", flush=True)
-        resp = requests.put(f"{MAX_API_URL}/messages", params={"message_id": mid}, json=body, headers=HEADERS, timeout=20)
-        if not resp.ok:
+        resp = MAX.put("/messages", params={"message_id": mid}, json=body)
+        if not resp.is_success:
             print(f"❌ [DEBUG] Ошибка редактирования MAX: {resp.status_code} {resp.text}", flush=True)
     except Exception as e:
         print(f"❌ [DEBUG] Исключение редактирования MAX: {e}", flush=True)
@@ -116,7 +124,7 @@ def delete_max_message(mid):
     if not mid:
         return
     try:
-        requests.delete(f"{MAX_API_URL}/messages", params={"message_id": mid}, headers=HEADERS, timeout=10)
+        MAX.delete("/messages", params={"message_id": mid}, timeout=10)
     except Exception:
         pass
 
@@ -125,7 +133,8 @@ def answer_max_callback(callback_id):
     if not callback_id:
         return
     try:
-        requests.post(f"{MAX_API_URL}/answers", params={"callback_id": callback_id}, json={}, headers=HEADERS, timeout=1.5)
+        # Ответ на нажатие не ретраим: кнопка «отпустится» и без него, а повтор только задержит обработку.
+        MAX.post("/answers", params={"callback_id": callback_id}, json={}, timeout=1.5, attempts=1)
     except Exception:
         pass
 
@@ -230,9 +239,10 @@ def _show_message(chat_id, mid, text, reply_markup):
         send_max_message(chat_id, text, reply_markup=reply_markup)
 
 
-def _render_doc(chat_id, doc_id, mid):
-    doc = get_doc(doc_id) or {}
-    _show_message(chat_id, mid, format_for_driver(doc_id, doc.get("ocr_data", {}), True, "", 1.0), build_main_kb(doc_id))
+def _render_doc(chat_id, doc_id, mid, doc=None):
+    # doc уже есть, если его вернул атомарный патч из db — повторный get_doc не нужен.
+    doc = doc or get_doc(doc_id) or {}
+    _show_message(chat_id, mid, format_for_driver(doc_id, doc.get("ocr_data", {}), True, "", 1.0, doc.get("operation_events")), build_main_kb(doc_id))
 
 
 def _extract_doc_id_from_payload(payload):
@@ -267,8 +277,7 @@ def handle_callback(chat_id, data, callback_id, mid):
             except (ValueError, IndexError):
                 _show_message(chat_id, mid, "⚠️ Не удалось выбрать вариант. Нажмите кнопку ещё раз.", build_unload_kb(doc_id))
                 return
-            update_field(doc_id, "unloading_address", value)
-            _render_doc(chat_id, doc_id, mid)
+            _render_doc(chat_id, doc_id, mid, update_field(doc_id, "unloading_address", value))
 
         elif data.startswith("set_carrier:"):
             _, did, raw_idx = data.split(":", 2)
@@ -279,8 +288,7 @@ def handle_callback(chat_id, data, callback_id, mid):
             except (ValueError, IndexError):
                 _show_message(chat_id, mid, "⚠️ Не удалось выбрать вариант. Нажмите кнопку ещё раз.", build_carrier_kb(doc_id))
                 return
-            update_field(doc_id, "carrier_name", value)
-            _render_doc(chat_id, doc_id, mid)
+            _render_doc(chat_id, doc_id, mid, update_field(doc_id, "carrier_name", value))
 
         elif data.startswith("set_op:"):
             _, did, op = data.split(":")
@@ -299,13 +307,11 @@ def handle_callback(chat_id, data, callback_id, mid):
 
         elif data.startswith("rm_last_op:"):
             doc_id = int(data.split(":")[1])
-            remove_last_operation_event(doc_id)
-            _render_doc(chat_id, doc_id, mid)
+            _render_doc(chat_id, doc_id, mid, remove_last_operation_event(doc_id))
 
         elif data.startswith("clear_ops:"):
             doc_id = int(data.split(":")[1])
-            clear_operation_events(doc_id)
-            _render_doc(chat_id, doc_id, mid)
+            _render_doc(chat_id, doc_id, mid, clear_operation_events(doc_id))
 
         elif data.startswith("edit:"):
             doc_id = int(data.split(":")[1])
@@ -340,11 +346,11 @@ def handle_callback(chat_id, data, callback_id, mid):
                 errors.append("Статус")
 
             if errors:
-                edit_max_message(mid, f"⛔ **ЗАПОЛНИТЕ ПОЛЯ:** {', '.join(errors)}\n\n{format_for_driver(doc_id, ocr, True, '', 1.0)}", reply_markup=build_main_kb(doc_id))
+                edit_max_message(mid, f"⛔ **ЗАПОЛНИТЕ ПОЛЯ:** {', '.join(errors)}\n\n{format_for_driver(doc_id, ocr, True, '', 1.0, doc.get('operation_events'))}", reply_markup=build_main_kb(doc_id))
                 return
 
             edit_max_message(mid, "🚀 Отправляю в Битрикс24...")
-            rds.rpush("tasks", json.dumps({"type": "bitrix_export", "platform": "max", "chat_id": str(chat_id), "doc_id": doc_id, "mid": mid}))
+            enqueue(rds, {"type": "bitrix_export", "platform": "max", "chat_id": str(chat_id), "doc_id": doc_id, "mid": mid})
     except Exception as exc:
         print(f"❌ Callback handling failed for payload '{data}': {exc}", flush=True)
         doc_id = _extract_doc_id_from_payload(data)
@@ -392,7 +398,7 @@ def process_update(update):
     if update_type == "message_callback":
         chat_id, payload, callback_id, mid = _extract_callback_meta(update)
         if chat_id and payload:
-            CALLBACK_EXECUTOR.submit(handle_callback, chat_id, payload, callback_id, mid)
+            handle_callback(chat_id, payload, callback_id, mid)
         else:
             print(f"⚠️ Ignored callback update with missing data: {update}", flush=True)
         return
@@ -429,17 +435,17 @@ def process_update(update):
             return
 
         if field == "operation_date":
-            if value in ("+", "＋", ""):
-                doc = get_doc(doc_id) or {}
-                value = (doc.get("ocr_data") or {}).get("loading_date", {}).get("value", "")
-            latest_doc = get_doc(doc_id) or {}
-            op_type = state.get("pending_op_type") or (latest_doc.get("ocr_data") or {}).get("operation_type", {}).get("value")
-            add_operation_event(doc_id, op_type, value)
+            op_type = state.get("pending_op_type")
+            if value in ("+", "＋", "") or not op_type:
+                ocr = (get_doc(doc_id) or {}).get("ocr_data") or {}
+                if value in ("+", "＋", ""):
+                    value = ocr.get("loading_date", {}).get("value", "")
+                op_type = op_type or ocr.get("operation_type", {}).get("value")
+            doc = add_operation_event(doc_id, op_type, value, actor=f"max:{chat_id}")
         else:
-            update_field(doc_id, field, value)
+            doc = update_field(doc_id, field, value)
 
-        doc = get_doc(doc_id)
-        msg_text = format_for_driver(doc_id, doc.get("ocr_data", {}), True, "", 1.0)
+        msg_text = format_for_driver(doc_id, doc.get("ocr_data", {}), True, "", 1.0, doc.get("operation_events"))
         if state.get("original_mid"):
             edit_max_message(state["original_mid"], msg_text, reply_markup=build_main_kb(doc_id))
         delete_max_message(state.get("prompt_mid"))
@@ -455,21 +461,28 @@ def process_update(update):
         add_to_buffer(chat_id, urls)
 
 
+def _update_chat_id(update):
+    if update.get("update_type") == "message_callback":
+        return _extract_callback_meta(update)[0]
+    return update.get("message", {}).get("recipient", {}).get("chat_id") or update.get("chat_id")
+
+
+DISPATCHER = ShardedDispatcher(process_update, MAX_DISPATCH_SHARDS, name="max-dispatch")
+
+
 def polling_loop():
     marker = None
     print("🚀 [DEBUG] Polling loop started... (API RESTARTED)", flush=True)
     while True:
         try:
-            resp = requests.get(f"{MAX_API_URL}/updates", headers=HEADERS, params={"marker": marker} if marker else {}, timeout=60)
+            resp = MAX.get("/updates", params={"marker": marker} if marker else {}, timeout=60, attempts=1)
             if resp.status_code == 200:
                 data = resp.json()
                 if "marker" in data:
                     marker = data["marker"]
+                # Опрос не ждёт обработки: апдейты уходят в шард своего чата.
                 for u in data.get("updates", []):
-                    try:
-                        process_update(u)
-                    except Exception as exc:
-                        print(f"❌ Failed to process update: {exc}; update={u}", flush=True)
+                    DISPATCHER.submit(_update_chat_id(u), u)
             else:
                 print(f"⚠️ [DEBUG] Ошибка polling: {resp.status_code} {resp.text}", flush=True)
                 time.sleep(2)
@@ -478,6 +491,23 @@ def polling_loop():
             time.sleep(5)
 
 
+@app.get("/health/db")
+def db_health():
+    return pool_stats()
+
+
+@app.get("/health/dispatcher")
+def dispatcher_health():
+    return DISPATCHER.stats()
+
+
+@app.get("/health/http")
+def http_health():
+    return platform_http.stats()
+
+
 @app.on_event("startup")
 def startup_event():
+    check_schema()
+    DISPATCHER.start()
     threading.Thread(target=polling_loop, daemon=True).start()
@@ -0,0 +1,132 @@
+import os, random, threading, time
+import httpx
+
+# Общий HTTP-клиент для API мессенджеров (MAX, Telegram). Файл одинаковый в api и worker.
+# Keep-alive пул на хост, HTTP/2 там, где сервер его поддерживает (согласуется через ALPN,
+# иначе HTTP/1.1), единые ретраи с учётом 429 retry_after и гистограммы задержек по эндпоинтам.
+PLATFORM_HTTP2 = os.getenv("PLATFORM_HTTP2", "on").lower() not in ("0", "off", "false", "no")
+PLATFORM_POOL_SIZE = int(os.getenv("PLATFORM_POOL_SIZE", os.getenv("HTTP_POOL_SIZE", "16")))
+PLATFORM_MAX_ATTEMPTS = int(os.getenv("PLATFORM_MAX_ATTEMPTS", "3"))
+PLATFORM_RETRY_BASE = float(os.getenv("PLATFORM_RETRY_BASE", "0.5"))
+# Если платформа просит подождать дольше — не спим, а отдаём 429 вызывающему коду.
+PLATFORM_RETRY_AFTER_MAX = float(os.getenv("PLATFORM_RETRY_AFTER_MAX", "30"))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _http2_supported():
+    try:
+        import h2  # noqa: F401
+        return PLATFORM_HTTP2
+    except ImportError:
+        return False
+
+
+def _observe(endpoint, seconds, outcome):
+    with _stats_lock:
+        st = _stats.setdefault(endpoint, {"count": 0, "sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1), "outcomes": {}})
+        st["count"] += 1
+        st["sum"] += seconds
+        idx = next((i for i, b in enumerate(LATENCY_BUCKETS) if seconds <= b), len(LATENCY_BUCKETS))
+        st["buckets"][idx] += 1
+        st["outcomes"][str(outcome)] = st["outcomes"].get(str(outcome), 0) + 1
+
+
+def _quantile(buckets, count, q):
+    # Верхняя граница корзины, в которую попадает квантиль; None — за пределами последней корзины.
+    rank, seen = q * count, 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= rank:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def stats():
+    """{эндпоинт: count, avg, p50/p95/p99 (по корзинам), гистограмма le→count, исходы (HTTP-коды/error)}."""
+    with _stats_lock:
+        snap = {k: {"count": v["count"], "sum": v["sum"], "buckets": list(v["buckets"]), "outcomes": dict(v["outcomes"])} for k, v in _stats.items()}
+    out = {}
+    for endpoint, st in snap.items():
+        labels = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+        out[endpoint] = {
+            "count": st["count"],
+            "avg": round(st["sum"] / st["count"], 3) if st["count"] else 0.0,
+            "p50": _quantile(st["buckets"], st["count"], 0.50),
+            "p95": _quantile(st["buckets"], st["count"], 0.95),
+            "p99": _quantile(st["buckets"], st["count"], 0.99),
+            "histogram": dict(zip(labels, st["buckets"])),
+            "outcomes": st["outcomes"],
+        }
+    return out
+
+
+def _retry_after(resp):
+    try:
+        header = resp.headers.get("retry-after")
+        if header:
+            return float(header)
+        body = resp.json()
+        # Telegram: {"parameters": {"retry_after": N}}; MAX и прочие — retry_after на верхнем уровне.
+        value = (body.get("parameters") or {}).get("retry_after") or body.get("retry_after")
+        return float(value) if value is not None else None
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+class PlatformClient:
+    def __init__(self, name, base_url="", headers=None, timeout=20.0):
+        self.name = name
+        self.client = httpx.Client(
+            base_url=base_url or "",
+            headers=headers,
+            http2=_http2_supported(),
+            limits=httpx.Limits(max_connections=PLATFORM_POOL_SIZE, max_keepalive_connections=PLATFORM_POOL_SIZE, keepalive_expiry=120),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+        )
+
+    def request(self, method, url, endpoint=None, attempts=None, **kwargs) -> httpx.Response:
+        """
+        Запрос с ретраями на сетевые ошибки, 5xx и 429 (пауза — retry_after платформы или экспонента с джиттером).
+        Возвращает последний ответ; сетевая ошибка последней попытки пробрасывается.
+        endpoint — метка для гистограммы, если url содержит идентификаторы (пути файлов и т.п.).
+        """
+        label = f"{self.name} {method} {endpoint or url}"
+        attempts = attempts or PLATFORM_MAX_ATTEMPTS
+        for attempt in range(1, attempts + 1):
+            started = time.monotonic()
+            try:
+                resp = self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                _observe(label, time.monotonic() - started, "error")
+                if attempt == attempts:
+                    raise
+                delay = PLATFORM_RETRY_BASE * 2 ** (attempt - 1) * random.uniform(0.7, 1.3)
+                print(f"🔁 [HTTP] {label}: {type(e).__name__}, повтор через {delay:.1f}s", flush=True)
+                time.sleep(delay)
+                continue
+            _observe(label, time.monotonic() - started, resp.status_code)
+            if attempt == attempts or not (resp.status_code == 429 or resp.status_code >= 500):
+                return resp
+            delay = _retry_after(resp) if resp.status_code == 429 else None
+            if delay is not None and delay > PLATFORM_RETRY_AFTER_MAX:
+                return resp
+            delay = delay if delay is not None else PLATFORM_RETRY_BASE * 2 ** (attempt - 1) * random.uniform(0.7, 1.3)
+            print(f"🔁 [HTTP] {label}: HTTP {resp.status_code}, повтор через {delay:.1f}s", flush=True)
+            time.sleep(delay)
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
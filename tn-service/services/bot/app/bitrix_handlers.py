@@ -1,9 +1,10 @@
-import logging
-from app.db import get_doc, set_confirmed, set_bitrix_result
-from app.bitrix_client import send_to_bitrix_sync
-from app.formatting import format_for_driver
+import logging, os, redis
+from app.db import get_doc
+from app.task_queue import enqueue
+from app.concurrency import run_blocking
 
 log = logging.getLogger("bitrix_handler")
+rds = redis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
 
 async def handle_bitrix_callback(update, context) -> bool:
     query = update.callback_query
@@ -11,7 +12,7 @@ async def handle_bitrix_callback(update, context) -> bool:
         return False
 
     doc_id = int(query.data.split(":")[1])
-    doc = get_doc(doc_id)
+    doc = await run_blocking(get_doc, doc_id)
     if not doc: 
         return True
 
@@ -22,28 +23,15 @@ async def handle_bitrix_callback(update, context) -> bool:
         await query.answer("⛔ ОШИБКА: Введите перевозчика перед подтверждением!", show_alert=True)
         return True
 
-    await query.answer("🚀 Отправляю в Битрикс24 (может занять время из-за фото)...")
-    
+    await query.answer("🚀 Отправляю в Битрикс24...")
+
+    # Выгрузка фото идёт в воркере; карточка накладной превращается в сообщение о статусе,
+    # и воркер отредактирует его результатом отправки.
     try:
-        msg_text = format_for_driver(doc_id, ocr, True, "", 1.0)
-        
-        # Читаем строку с путями и аккуратно разбиваем ее в список для отправки
-        raw_paths = doc.get("photo_path")
-        photo_paths = raw_paths.split(",") if raw_paths else []
-        
-        ok, resp, err, payload = send_to_bitrix_sync(text=msg_text, photo_paths=photo_paths)
-        
-        if ok:
-            msg_id = str(resp.get("result", ""))
-            set_confirmed(doc_id)
-            set_bitrix_result(doc_id, msg_id, "success")
-            await query.message.reply_text("✅ Успешно! Данные и все фото отправлены в Битрикс24.")
-        else:
-            log.error(f"Bitrix response error: {err}")
-            await query.message.reply_text(f"❌ Ошибка отправки: {err}")
-            
+        await query.edit_message_text("🚀 Отправляю в Битрикс24 (может занять время из-за фото)...")
+        mid = query.message.message_id
     except Exception as e:
-        log.error(f"Bitrix Send Error: {e}")
-        await query.message.reply_text(f"❌ Критическая ошибка: {e}")
-    
+        log.warning(f"Cannot edit card before export: {e}")
+        mid = None
+    await run_blocking(enqueue, rds, {"type": "bitrix_export", "platform": "telegram", "chat_id": query.message.chat_id, "doc_id": doc_id, "mid": mid})
     return True
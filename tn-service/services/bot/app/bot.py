@@ -1,9 +1,12 @@
-import os, json, logging, redis, asyncio
+import os, logging, redis, asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from app.db import set_status, update_field, get_doc, add_operation_event, remove_last_operation_event, clear_operation_events
 from app.formatting import format_for_driver
+from app.task_queue import enqueue
+from app.migrations import check_schema
 from app.bitrix_handlers import handle_bitrix_callback
+from app.concurrency import run_blocking, PerChatUpdateProcessor, BOT_CONCURRENT_UPDATES
 
 logging.basicConfig(level=logging.INFO)
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -18,8 +21,8 @@ EDIT_STATE = {}
 
 
 
-def _suggest_values(doc_id, field):
-    doc = get_doc(doc_id) or {}
+async def _suggest_values(doc_id, field):
+    doc = await run_blocking(get_doc, doc_id) or {}
     ocr = doc.get("ocr_data") or {}
     values = []
 
@@ -44,8 +47,8 @@ def _suggest_values(doc_id, field):
     return out
 
 
-def _build_suggested_rows(doc_id, field, prefix, emoji):
-    suggestions = _suggest_values(doc_id, field)
+async def _build_suggested_rows(doc_id, field, prefix, emoji):
+    suggestions = await _suggest_values(doc_id, field)
     rows = []
     for idx, value in enumerate(suggestions):
         rows.append([InlineKeyboardButton(f"{emoji} {value}", callback_data=f"{prefix}:{doc_id}:{idx}")])
@@ -80,15 +83,15 @@ def build_op_kb(doc_id):
     ])
 
 
-def build_unload_kb(doc_id):
-    rows = _build_suggested_rows(doc_id, "unloading_address", "set_unload", "📍")
+async def build_unload_kb(doc_id):
+    rows = await _build_suggested_rows(doc_id, "unloading_address", "set_unload", "📍")
     rows.append([InlineKeyboardButton("✍️ Свой вариант", callback_data=f"field:{doc_id}:unloading_address")])
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"back:{doc_id}")])
     return InlineKeyboardMarkup(rows)
 
 
-def build_carrier_kb(doc_id):
-    rows = _build_suggested_rows(doc_id, "carrier_name", "set_carrier", "🚚")
+async def build_carrier_kb(doc_id):
+    rows = await _build_suggested_rows(doc_id, "carrier_name", "set_carrier", "🚚")
     rows.append([InlineKeyboardButton("✍️ Свой вариант", callback_data=f"field:{doc_id}:carrier_name")])
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"back:{doc_id}")])
     return InlineKeyboardMarkup(rows)
@@ -114,8 +117,14 @@ async def flush_buffer(chat_id, context):
     files = CHAT_BUFFERS.pop(chat_id)
     if not files:
         return
-    rds.rpush("tasks", json.dumps({"type": "batch", "chat_id": chat_id, "files": files}))
-    await context.bot.send_message(chat_id, f"📥 Файлы ({len(files)} шт) приняты. Анализирую...")
+    # Сначала подтверждение: воркер будет редактировать это же сообщение (прогресс и итоговая карточка).
+    try:
+        ack = await context.bot.send_message(chat_id, f"📥 Файлы ({len(files)} шт) приняты. Анализирую...")
+        ack_mid = ack.message_id
+    except Exception as e:
+        print(f"⚠️ [BOT] Не удалось отправить подтверждение в {chat_id}: {e}", flush=True)
+        ack_mid = None
+    await run_blocking(enqueue, rds, {"type": "batch", "chat_id": chat_id, "files": files, "ack_mid": ack_mid})
 
 
 async def on_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -152,48 +161,46 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("menu_unload:"):
         doc_id = int(data.split(":")[1])
-        await context.bot.send_message(chat_id, "👇 Выберите локацию выгрузки или введите свою:", reply_markup=build_unload_kb(doc_id))
+        await context.bot.send_message(chat_id, "👇 Выберите локацию выгрузки или введите свою:", reply_markup=await build_unload_kb(doc_id))
 
     elif data.startswith("menu_carrier:"):
         doc_id = int(data.split(":")[1])
-        await context.bot.send_message(chat_id, "👇 Выберите наименование перевозчика или введите своё:", reply_markup=build_carrier_kb(doc_id))
+        await context.bot.send_message(chat_id, "👇 Выберите наименование перевозчика или введите своё:", reply_markup=await build_carrier_kb(doc_id))
 
     elif data.startswith("set_unload:"):
         _, did, raw_idx = data.split(":", 2)
         doc_id = int(did)
-        suggestions = _suggest_values(doc_id, "unloading_address")
+        suggestions = await _suggest_values(doc_id, "unloading_address")
         try:
             value = suggestions[int(raw_idx)]
         except (ValueError, IndexError):
             await context.bot.send_message(chat_id, "⚠️ Не удалось выбрать вариант. Нажмите кнопку ещё раз.")
             return
-        update_field(doc_id, "unloading_address", value)
-        doc = get_doc(doc_id) or {}
+        doc = await run_blocking(update_field, doc_id, "unloading_address", value) or {}
         ocr = doc.get("ocr_data") or {}
         miss = not ocr.get("carrier_name", {}).get("value")
-        msg = format_for_driver(doc_id, ocr, True, "", 1.0)
+        msg = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
         await context.bot.send_message(chat_id, msg, reply_markup=build_main_kb(doc_id, miss))
 
     elif data.startswith("set_carrier:"):
         _, did, raw_idx = data.split(":", 2)
         doc_id = int(did)
-        suggestions = _suggest_values(doc_id, "carrier_name")
+        suggestions = await _suggest_values(doc_id, "carrier_name")
         try:
             value = suggestions[int(raw_idx)]
         except (ValueError, IndexError):
             await context.bot.send_message(chat_id, "⚠️ Не удалось выбрать вариант. Нажмите кнопку ещё раз.")
             return
-        update_field(doc_id, "carrier_name", value)
-        doc = get_doc(doc_id) or {}
+        doc = await run_blocking(update_field, doc_id, "carrier_name", value) or {}
         ocr = doc.get("ocr_data") or {}
         miss = not ocr.get("carrier_name", {}).get("value")
-        msg = format_for_driver(doc_id, ocr, True, "", 1.0)
+        msg = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
         await context.bot.send_message(chat_id, msg, reply_markup=build_main_kb(doc_id, miss))
 
     elif data.startswith("set_op:"):
         _, did, op = data.split(":")
         doc_id = int(did)
-        doc = get_doc(doc_id) or {}
+        doc = await run_blocking(get_doc, doc_id) or {}
         ocr = doc.get("ocr_data") or {}
         default_date = ocr.get("loading_date", {}).get("value", "")
         EDIT_STATE[chat_id] = {"doc_id": doc_id, "field": "operation_date", "pending_op_type": op}
@@ -204,20 +211,18 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("rm_last_op:"):
         doc_id = int(data.split(":")[1])
-        remove_last_operation_event(doc_id)
-        doc = get_doc(doc_id) or {}
+        doc = await run_blocking(remove_last_operation_event, doc_id) or {}
         ocr = doc.get("ocr_data") or {}
         miss = not ocr.get("carrier_name", {}).get("value")
-        msg = format_for_driver(doc_id, ocr, True, "", 1.0)
+        msg = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
         await context.bot.send_message(chat_id, msg, reply_markup=build_main_kb(doc_id, miss))
 
     elif data.startswith("clear_ops:"):
         doc_id = int(data.split(":")[1])
-        clear_operation_events(doc_id)
-        doc = get_doc(doc_id) or {}
+        doc = await run_blocking(clear_operation_events, doc_id) or {}
         ocr = doc.get("ocr_data") or {}
         miss = not ocr.get("carrier_name", {}).get("value")
-        msg = format_for_driver(doc_id, ocr, True, "", 1.0)
+        msg = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
         await context.bot.send_message(chat_id, msg, reply_markup=build_main_kb(doc_id, miss))
 
     elif data.startswith("edit:"):
@@ -229,11 +234,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("back:"):
         doc_id = int(data.split(":")[1])
-        doc = get_doc(doc_id)
+        doc = await run_blocking(get_doc, doc_id)
         if doc:
             ocr = doc.get("ocr_data") or {}
             miss = not ocr.get("carrier_name", {}).get("value")
-            msg = format_for_driver(doc_id, ocr, True, "", 1.0)
+            msg = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
             await context.bot.send_message(chat_id, msg, reply_markup=build_main_kb(doc_id, miss))
 
     elif data.startswith("field:"):
@@ -260,7 +265,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     value = update.message.text.strip()
 
     if field == "operation_type":
-        doc = get_doc(doc_id) or {}
+        doc = await run_blocking(get_doc, doc_id) or {}
         ocr = doc.get("ocr_data") or {}
         default_date = ocr.get("loading_date", {}).get("value", "")
         EDIT_STATE[chat_id] = {"doc_id": doc_id, "field": "operation_date", "pending_op_type": value}
@@ -271,27 +276,26 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if field == "operation_date":
-        if value in ("+", "＋", ""):
-            doc = get_doc(doc_id) or {}
-            value = (doc.get("ocr_data") or {}).get("loading_date", {}).get("value", "")
         op_type = state.get("pending_op_type")
-        if not op_type:
-            doc = get_doc(doc_id) or {}
-            op_type = (doc.get("ocr_data") or {}).get("operation_type", {}).get("value")
-        add_operation_event(doc_id, op_type, value)
+        if value in ("+", "＋", "") or not op_type:
+            ocr = (await run_blocking(get_doc, doc_id) or {}).get("ocr_data") or {}
+            if value in ("+", "＋", ""):
+                value = ocr.get("loading_date", {}).get("value", "")
+            op_type = op_type or ocr.get("operation_type", {}).get("value")
+        doc = await run_blocking(add_operation_event, doc_id, op_type, value, actor=f"telegram:{chat_id}")
     else:
-        update_field(doc_id, field, value)
+        doc = await run_blocking(update_field, doc_id, field, value)
 
-    doc = get_doc(doc_id)
     ocr = doc.get("ocr_data") or {}
     miss = not ocr.get("carrier_name", {}).get("value")
-    msg = format_for_driver(doc_id, ocr, True, "", 1.0)
+    msg = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
 
     await update.message.reply_text(f"✅ Данные обновлены:\n\n{msg}", reply_markup=build_main_kb(doc_id, miss))
 
 
 def main():
-    app = Application.builder().token(TOKEN).build()
+    check_schema()
+    app = Application.builder().token(TOKEN).concurrent_updates(PerChatUpdateProcessor(BOT_CONCURRENT_UPDATES)).build()
     app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL | filters.Sticker.ALL, on_media))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     app.add_handler(CallbackQueryHandler(on_callback))
@@ -0,0 +1,50 @@
+import asyncio, os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from telegram.ext import BaseUpdateProcessor
+
+# Синхронные вызовы Postgres/Redis уходят в ограниченный пул потоков, чтобы не
+# останавливать event loop бота: пока один чат ждёт БД, остальные обрабатываются.
+BOT_IO_THREADS = int(os.getenv("BOT_IO_THREADS", os.getenv("DB_POOL_MAX", "5")))
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32"))
+
+_executor = ThreadPoolExecutor(max_workers=BOT_IO_THREADS, thread_name_prefix="bot-io")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обновления разных чатов обрабатываются параллельно (не больше max_concurrent_updates),
+    а обновления одного чата — строго по очереди, в порядке поступления.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+        self._users = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        lock = self._locks.setdefault(chat.id, asyncio.Lock())
+        self._users[chat.id] = self._users.get(chat.id, 0) + 1
+        try:
+            # asyncio.Lock будит ожидающих в порядке очереди — порядок обновлений чата сохраняется.
+            async with lock:
+                await coroutine
+        finally:
+            self._users[chat.id] -= 1
+            if not self._users[chat.id]:
+                del self._users[chat.id]
+                del self._locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,252 @@
+import os, sys, time
+from datetime import datetime
+import psycopg
+from psycopg.rows import dict_row
+
+# Версионные миграции схемы. Файл одинаковый в api, bot и worker: применяет их
+# одноразовый сервис migrate (python -m app.migrations migrate), а сервисы на старте
+# только сверяют версию схемы (check_schema) и не выполняют DDL сами.
+DATABASE_URL = os.getenv("DATABASE_URL", "").replace("DATABASE_URL=", "").strip("'\"")
+SCHEMA_WAIT_TIMEOUT = float(os.getenv("SCHEMA_WAIT_TIMEOUT", "300"))
+
+# Ключ pg_advisory_lock: два одновременно запущенных мигратора не мешают друг другу.
+LOCK_KEY = 7710001
+
+
+def concurrent_index(name, definition):
+    """CREATE INDEX CONCURRENTLY без блокировки записи; недостроенный (INVALID) индекс от прерванной попытки пересоздаётся."""
+    def step(conn):
+        invalid = conn.execute(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %s AND NOT i.indisvalid",
+            (name,),
+        ).fetchone()
+        if invalid:
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+    return step
+
+
+def _event_day(value):
+    try:
+        return datetime.strptime((value or "").strip(), "%d.%m.%Y").date()
+    except ValueError:
+        return None
+
+
+def backfill_operation_events(conn, batch=500):
+    """Переносит массивы ocr_data.operation_events в таблицу и убирает их из JSON; пачками, чтобы не держать долгих блокировок."""
+    moved = 0
+    while True:
+        with conn.transaction():
+            rows = conn.execute(
+                "SELECT id, ocr_data->'operation_events' AS events, updated_at FROM transport_documents "
+                "WHERE ocr_data ? 'operation_events' ORDER BY id LIMIT %s FOR UPDATE",
+                (batch,),
+            ).fetchall()
+            if not rows:
+                break
+            with conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT INTO operation_events (doc_id, type, event_date, event_day, actor, created_at) VALUES (%s, %s, %s, %s, 'backfill', %s)",
+                    [
+                        (r["id"], e.get("type"), e.get("date"), _event_day(e.get("date")), r["updated_at"])
+                        for r in rows if isinstance(r["events"], list)
+                        for e in r["events"] if isinstance(e, dict)
+                    ],
+                )
+            conn.execute(
+                "UPDATE transport_documents SET ocr_data = ocr_data - 'operation_events' WHERE id = ANY(%s)",
+                ([r["id"] for r in rows],),
+            )
+        moved += len(rows)
+    if moved:
+        print(f"🗂 [MIGRATE] Статусы {moved} документов перенесены в operation_events", flush=True)
+
+
+# (версия, название, шаги). Шаг — SQL-строка или функция conn -> None. Миграция только из
+# SQL-строк выполняется одной транзакцией вместе с записью версии.
+MIGRATIONS = [
+    (1, "transport_documents", [
+        """
+        CREATE TABLE IF NOT EXISTS transport_documents (
+          id BIGSERIAL PRIMARY KEY,
+          telegram_chat_id BIGINT,
+          telegram_file_id TEXT,
+          photo_path TEXT,
+          ocr_data JSONB,
+          ocr_raw TEXT,
+          confidence FLOAT,
+          status TEXT,
+          error_reason TEXT,
+          created_at TIMESTAMP DEFAULT now(),
+          updated_at TIMESTAMP DEFAULT now(),
+          bitrix_deal_id TEXT,
+          bitrix_status TEXT,
+          confirmed_at TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "operation_events", [
+        """
+        CREATE TABLE IF NOT EXISTS operation_events (
+          id BIGSERIAL PRIMARY KEY,
+          doc_id BIGINT NOT NULL REFERENCES transport_documents(id) ON DELETE CASCADE,
+          type TEXT,
+          event_date TEXT,
+          event_day DATE,
+          actor TEXT,
+          created_at TIMESTAMP DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS operation_events_doc_idx ON operation_events (doc_id, id)",
+        "CREATE INDEX IF NOT EXISTS operation_events_type_day_idx ON operation_events (type, event_day)",
+        "CREATE INDEX IF NOT EXISTS operation_events_created_idx ON operation_events (created_at)",
+    ]),
+    (3, "backfill operation_events", [backfill_operation_events]),
+    (4, "transport_documents indexes", [
+        # Последние документы чата (подсказки, история водителя).
+        concurrent_index("transport_documents_chat_recent_idx", "transport_documents (telegram_chat_id, created_at DESC)"),
+        # Неподтверждённый хвост: частичный индекс остаётся маленьким.
+        concurrent_index("transport_documents_unconfirmed_idx", "transport_documents (created_at) WHERE confirmed_at IS NULL"),
+        concurrent_index("transport_documents_status_idx", "transport_documents (status, created_at)"),
+        # Выборки за период.
+        concurrent_index("transport_documents_created_idx", "transport_documents (created_at)"),
+        concurrent_index("transport_documents_confirmed_idx", "transport_documents (confirmed_at) WHERE confirmed_at IS NOT NULL"),
+        # Поиск по содержимому накладной: ocr_data @> '{"carrier_name": {"value": "..."}}'.
+        concurrent_index("transport_documents_ocr_gin_idx", "transport_documents USING gin (ocr_data jsonb_path_ops)"),
+    ]),
+    (5, "bitrix_exports outbox", [
+        # Одна строка на выгрузку документа; steps — что уже сделано в Битриксе
+        # (folder_id, disk_ids по номеру фото, committed, message_id), чтобы повтор продолжал с места сбоя.
+        """
+        CREATE TABLE IF NOT EXISTS bitrix_exports (
+          id BIGSERIAL PRIMARY KEY,
+          doc_id BIGINT NOT NULL REFERENCES transport_documents(id) ON DELETE CASCADE,
+          idempotency_key TEXT NOT NULL UNIQUE,
+          state TEXT NOT NULL DEFAULT 'pending',
+          steps JSONB NOT NULL DEFAULT '{}'::jsonb,
+          text TEXT,
+          photo_paths TEXT,
+          platform TEXT,
+          chat_id TEXT,
+          mid TEXT,
+          attempts INT NOT NULL DEFAULT 0,
+          last_error TEXT,
+          next_attempt_at TIMESTAMP NOT NULL DEFAULT now(),
+          locked_until TIMESTAMP,
+          created_at TIMESTAMP DEFAULT now(),
+          updated_at TIMESTAMP DEFAULT now(),
+          finished_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS bitrix_exports_due_idx ON bitrix_exports (next_attempt_at) WHERE state IN ('pending', 'retry', 'in_progress')",
+    ]),
+    (6, "batch_tasks", [
+        # Какой документ создала задача распознавания: повтор или перехват той же задачи
+        # не заводит вторую строку transport_documents.
+        """
+        CREATE TABLE IF NOT EXISTS batch_tasks (
+          task_id TEXT PRIMARY KEY,
+          doc_id BIGINT REFERENCES transport_documents(id) ON DELETE CASCADE,
+          created_at TIMESTAMP DEFAULT now()
+        )
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _connect(attempts=30):
+    # На старте compose Postgres может ещё подниматься.
+    for attempt in range(1, attempts + 1):
+        try:
+            return psycopg.connect(DATABASE_URL, autocommit=True, row_factory=dict_row)
+        except psycopg.OperationalError as e:
+            if attempt == attempts:
+                raise
+            print(f"⏳ [MIGRATE] База недоступна ({e}), повтор через 2s", flush=True)
+            time.sleep(2)
+
+
+def _ensure_table(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+      version INT PRIMARY KEY,
+      name TEXT,
+      applied_at TIMESTAMP DEFAULT now()
+    )
+    """)
+
+
+def current_version(conn):
+    if not conn.execute("SELECT to_regclass('schema_migrations') AS t").fetchone()["t"]:
+        return 0
+    return conn.execute("SELECT COALESCE(max(version), 0) AS v FROM schema_migrations").fetchone()["v"]
+
+
+def migrate():
+    with _connect() as conn:
+        _ensure_table(conn)
+        conn.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        try:
+            version = current_version(conn)
+            for number, name, steps in MIGRATIONS:
+                if number <= version:
+                    continue
+                started = time.monotonic()
+                print(f"🛠 [MIGRATE] {number}: {name}", flush=True)
+                if all(isinstance(step, str) for step in steps):
+                    with conn.transaction():
+                        for step in steps:
+                            conn.execute(step)
+                        conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (number, name))
+                else:
+                    # CONCURRENTLY нельзя внутри транзакции, функции сами управляют транзакциями;
+                    # каждый шаг идемпотентен, поэтому прерванную миграцию можно просто запустить заново.
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+                    conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (number, name))
+                print(f"✅ [MIGRATE] {number}: {name} ({time.monotonic() - started:.1f}s)", flush=True)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+        return current_version(conn)
+
+
+def check_schema(timeout=None):
+    """Ждёт, пока мигратор доведёт схему до LATEST_VERSION; по таймауту — RuntimeError (сервис не стартует)."""
+    timeout = SCHEMA_WAIT_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        with _connect() as conn:
+            version = current_version(conn)
+        if version >= LATEST_VERSION:
+            return version
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"схема БД версии {version}, нужна {LATEST_VERSION}: запустите python -m app.migrations migrate")
+        print(f"⏳ [SCHEMA] Версия схемы {version} < {LATEST_VERSION}, ждём миграций...", flush=True)
+        time.sleep(5)
+
+
+def status():
+    with _connect() as conn:
+        applied = {}
+        if conn.execute("SELECT to_regclass('schema_migrations') AS t").fetchone()["t"]:
+            applied = {r["version"]: r["applied_at"] for r in conn.execute("SELECT version, applied_at FROM schema_migrations")}
+    for number, name, _ in MIGRATIONS:
+        mark = applied[number].strftime("%Y-%m-%d %H:%M") if number in applied else "pending"
+        print(f"{number:>3}  {name:<32} {mark}")
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if cmd == "migrate":
+        print(f"Схема на версии {migrate()}")
+    elif cmd == "status":
+        status()
+    else:
+        print("usage: python -m app.migrations migrate|status")
+        sys.exit(2)
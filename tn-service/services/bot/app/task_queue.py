@@ -0,0 +1,215 @@
+import json, os, random, sys, time
+import redis
+
+# Надёжная очередь задач на Redis Streams (consumer group + ack).
+# Файл одинаковый во всех сервисах: api/bot только кладут задачи, воркер читает и подтверждает.
+# Задачи разложены по полосам: короткие (экспорт в Битрикс) не ждут тяжёлый OCR.
+STREAM = os.getenv("TASK_STREAM", "tasks:stream")
+FAST_STREAM = os.getenv("TASK_FAST_STREAM", "tasks:stream:fast")
+LANES = {"fast": FAST_STREAM, "ocr": STREAM}
+FAST_TASK_TYPES = {"bitrix_export"}
+GROUP = os.getenv("TASK_GROUP", "workers")
+DEAD_STREAM = os.getenv("TASK_DEAD_STREAM", "tasks:dead")
+RETRY_ZSET = "tasks:retry"
+LEGACY_LIST = "tasks"
+
+MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("TASK_RETRY_BASE_DELAY", "5"))
+RETRY_MAX_DELAY = float(os.getenv("TASK_RETRY_MAX_DELAY", "300"))
+# Сообщение, которое висит у упавшего консьюмера дольше этого времени, забирает другой воркер.
+# Живой консьюмер продлевает свои сообщения (touch) каждые CLAIM_IDLE_MS / 3.
+CLAIM_IDLE_MS = int(os.getenv("TASK_CLAIM_IDLE_MS", "300000"))
+STREAM_MAXLEN = int(os.getenv("TASK_STREAM_MAXLEN", "100000"))
+
+
+def lane_for(task):
+    return "fast" if task.get("type", "batch") in FAST_TASK_TYPES else "ocr"
+
+
+def stream_for(data):
+    try:
+        return LANES[lane_for(json.loads(data))]
+    except Exception:
+        return STREAM
+
+
+def enqueue(rds, task, attempt=0):
+    fields = {"data": json.dumps(task, ensure_ascii=False), "attempt": attempt, "enqueued_at": time.time()}
+    return rds.xadd(LANES[lane_for(task)], fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+def ensure_group(rds):
+    for stream in LANES.values():
+        try:
+            rds.xgroup_create(stream, GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+def migrate_legacy_list(rds):
+    # Задачи, оставшиеся в старом списке "tasks" после деплоя, переносим в стрим.
+    moved = 0
+    while True:
+        raw = rds.lpop(LEGACY_LIST)
+        if raw is None:
+            break
+        rds.xadd(stream_for(raw), {"data": raw, "attempt": 0}, maxlen=STREAM_MAXLEN, approximate=True)
+        moved += 1
+    if moved:
+        print(f"📦 [QUEUE] Перенесено из старого списка '{LEGACY_LIST}': {moved}", flush=True)
+    return moved
+
+
+def read(rds, consumer, block_ms, lanes=("fast", "ocr"), count=1):
+    # Сначала неблокирующе проверяем полосы по приоритету, затем ждём на всех сразу.
+    for lane in lanes:
+        resp = rds.xreadgroup(GROUP, consumer, {LANES[lane]: ">"}, count=count)
+        if resp:
+            return _unpack(resp)
+    if not block_ms:
+        return []
+    resp = rds.xreadgroup(GROUP, consumer, {LANES[lane]: ">" for lane in lanes}, count=count, block=block_ms)
+    out = _unpack(resp)
+    order = [LANES[lane] for lane in lanes]
+    return sorted(out, key=lambda m: order.index(m[0]))
+
+
+def _unpack(resp):
+    out = []
+    for stream, messages in resp or []:
+        for msg_id, fields in messages:
+            out.append((stream, msg_id, fields))
+    return out
+
+
+def decode(fields):
+    return json.loads(fields["data"])
+
+
+def task_id(msg_id, fields):
+    # Постоянный id задачи: при повторе (retry/DLQ replay) сообщение получает новый id стрима, task_id остаётся прежним.
+    return fields.get("task_id") or msg_id
+
+
+def touch(rds, stream, msg_id, consumer):
+    # XCLAIM JUSTID своему же консьюмеру обнуляет idle, не увеличивая счётчик доставок.
+    rds.xclaim(stream, GROUP, consumer, 0, [msg_id], justid=True)
+
+
+def ack(rds, stream, msg_id):
+    pipe = rds.pipeline()
+    pipe.xack(stream, GROUP, msg_id)
+    pipe.xdel(stream, msg_id)
+    pipe.execute()
+
+
+def _backoff(attempt):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def dead_letter(rds, stream, msg_id, fields, error):
+    rds.xadd(DEAD_STREAM, {
+        "data": fields.get("data", ""),
+        "attempt": fields.get("attempt", 0),
+        "error": str(error)[:2000],
+        "source": stream,
+        "source_id": msg_id,
+        "task_id": task_id(msg_id, fields),
+        "failed_at": int(time.time()),
+    })
+    ack(rds, stream, msg_id)
+    print(f"☠️ [QUEUE] Задача {msg_id} отправлена в {DEAD_STREAM}: {error}", flush=True)
+
+
+def fail(rds, stream, msg_id, fields, error):
+    attempt = int(fields.get("attempt", 0)) + 1
+    if attempt >= MAX_ATTEMPTS:
+        dead_letter(rds, stream, msg_id, dict(fields, attempt=attempt), error)
+        return False
+    due = time.time() + _backoff(attempt)
+    member = json.dumps({"id": msg_id, "task_id": task_id(msg_id, fields), "stream": stream, "data": fields.get("data", ""), "attempt": attempt})
+    rds.zadd(RETRY_ZSET, {member: due})
+    ack(rds, stream, msg_id)
+    print(f"🔁 [QUEUE] Задача {msg_id}: попытка {attempt}/{MAX_ATTEMPTS}, повтор через {due - time.time():.0f}s", flush=True)
+    return True
+
+
+def promote_due(rds, limit=100):
+    # ZREM как "захват": из нескольких воркеров элемент вернёт в стрим только один.
+    moved = 0
+    for member in rds.zrangebyscore(RETRY_ZSET, 0, time.time(), start=0, num=limit):
+        if not rds.zrem(RETRY_ZSET, member):
+            continue
+        item = json.loads(member)
+        stream = item.get("stream") or STREAM
+        rds.xadd(stream, {"data": item["data"], "attempt": item["attempt"], "task_id": item.get("task_id") or item["id"]}, maxlen=STREAM_MAXLEN, approximate=True)
+        moved += 1
+    return moved
+
+
+def reclaim(rds, consumer, lanes=("fast", "ocr"), count=1):
+    # Забираем сообщения упавших/передеплоенных консьюмеров; слишком часто доставленные — в DLQ.
+    out = []
+    for lane in lanes:
+        stream = LANES[lane]
+        resp = rds.xautoclaim(stream, GROUP, consumer, CLAIM_IDLE_MS, start_id="0-0", count=count)
+        messages = resp[1] if resp and len(resp) > 1 else []
+        for msg_id, fields in messages:
+            if not fields:
+                continue
+            pending = rds.xpending_range(stream, GROUP, min=msg_id, max=msg_id, count=1)
+            delivered = pending[0]["times_delivered"] if pending else 1
+            attempt = int(fields.get("attempt", 0)) + delivered - 1
+            if attempt >= MAX_ATTEMPTS:
+                dead_letter(rds, stream, msg_id, dict(fields, attempt=attempt), "превышено число доставок (воркер падал на задаче)")
+                continue
+            print(f"♻️ [QUEUE] Забрана зависшая задача {msg_id} из {stream} (доставок: {delivered})", flush=True)
+            out.append((stream, msg_id, fields))
+        if out:
+            break
+    return out
+
+
+def depth(rds):
+    out = {}
+    for lane, stream in LANES.items():
+        try:
+            groups = rds.xinfo_groups(stream)
+            group = next((g for g in groups if g.get("name") == GROUP), {})
+            out[f"{lane}.ready"] = group.get("lag") or 0
+            out[f"{lane}.pending"] = group.get("pending") or 0
+        except redis.ResponseError:
+            out[f"{lane}.ready"], out[f"{lane}.pending"] = 0, 0
+    out["retry"] = rds.zcard(RETRY_ZSET)
+    out["dead"] = rds.xlen(DEAD_STREAM)
+    return out
+
+
+def list_dead(rds, count=50):
+    return rds.xrevrange(DEAD_STREAM, count=count)
+
+
+def replay_dead(rds, dead_id=None):
+    entries = rds.xrange(DEAD_STREAM, min=dead_id, max=dead_id) if dead_id else rds.xrange(DEAD_STREAM)
+    for entry_id, fields in entries:
+        stream = fields.get("source") or stream_for(fields["data"])
+        rds.xadd(stream, {"data": fields["data"], "attempt": 0, "task_id": fields.get("task_id") or fields.get("source_id") or entry_id}, maxlen=STREAM_MAXLEN, approximate=True)
+        rds.xdel(DEAD_STREAM, entry_id)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    # python -m app.task_queue dead            — посмотреть DLQ
+    # python -m app.task_queue replay [<id>]   — вернуть задачу (или все) в очередь
+    # python -m app.task_queue depth           — размеры очередей
+    rds = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"), decode_responses=True)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "depth"
+    if cmd == "dead":
+        for entry_id, fields in list_dead(rds):
+            print(entry_id, fields.get("attempt"), fields.get("error"), fields.get("data"))
+    elif cmd == "replay":
+        print(f"Возвращено в очередь: {replay_dead(rds, sys.argv[2] if len(sys.argv) > 2 else None)}")
+    else:
+        print(json.dumps(depth(rds)))
@@ -1,9 +1,7 @@
 import re
 from typing import Optional, Tuple
 
-import psycopg
-from psycopg.rows import dict_row
-from app.config import DATABASE_URL
+from app.db import connect
 
 
 def keyify(name: str | None, address: str | None) -> str:
@@ -52,7 +50,7 @@ def get_or_create_canonical(name: str | None, address: str | None) -> Tuple[str,
     RETURNING canonical_name, city;
     """
 
-    with psycopg.connect(DATABASE_URL, row_factory=dict_row) as conn:
+    with connect() as conn:
         with conn.cursor() as cur:
             cur.execute(q, (base_key, canonical, city))
             row = cur.fetchone()
@@ -0,0 +1,100 @@
+"""
+Сравнение старого и нового расчёта метрик "похожести на документ" на папке с фото:
+
+    python -m app.bench_metrics /tmp/photos [--limit 200] [--album 6]
+
+Старый вариант — полный кадр и list(gray.getdata()), новый — images.load + ocr.item_metrics.
+Фото обрабатываются альбомами по --album штук параллельно, как в воркере; кадры альбома
+держатся в памяти до его конца. Каждый вариант запускается в отдельном процессе, поэтому
+пик RSS (ru_maxrss) включает и нативные буферы PIL, а не только Python-аллокации.
+Печатает время, пик RSS и совпадение решений _is_likely_document.
+"""
+import argparse, glob, json, os, resource, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageFilter, ImageStat
+from app import images
+from app.ocr import item_metrics, _is_likely_document
+
+
+def legacy_metrics(path):
+    with Image.open(path) as img:
+        gray = img.convert("L")
+        width, height = gray.size
+        entropy = gray.entropy()
+        edge_mean = ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).mean[0]
+        pixels = list(gray.getdata())
+        white_ratio = sum(1 for p in pixels if p >= 200) / max(len(pixels), 1)
+        return (entropy, edge_mean, white_ratio, width, height), None
+
+
+def new_metrics(path):
+    item = images.load(path)
+    return item_metrics(item), item
+
+
+VARIANTS = {"old": legacy_metrics, "new": new_metrics}
+
+
+def _child(variant, paths, album):
+    fn = VARIANTS[variant]
+    out = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=album) as pool:
+        for i in range(0, len(paths), album):
+            chunk = paths[i:i + album]
+            held = []
+            for path, future in [(p, pool.submit(fn, p)) for p in chunk]:
+                try:
+                    metrics, item = future.result()
+                    out[path] = metrics
+                    held.append(item)
+                except Exception as e:
+                    print(f"  ! {path}: {e}", file=sys.stderr)
+            del held
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"metrics": out, "elapsed": elapsed, "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def _run(variant, args):
+    cmd = [sys.executable, "-m", "app.bench_metrics", args.corpus, "--variant", variant,
+           "--limit", str(args.limit), "--album", str(args.album)]
+    proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    sys.stderr.write(proc.stderr)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("corpus")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--album", type=int, default=6)
+    ap.add_argument("--variant", choices=sorted(VARIANTS))
+    args = ap.parse_args()
+
+    paths = sorted(p for ext in ("jpg", "jpeg", "png") for p in glob.glob(os.path.join(args.corpus, f"*.{ext}")))
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        raise SystemExit(f"Нет изображений в {args.corpus}")
+    if args.variant:
+        _child(args.variant, paths, args.album)
+        return
+
+    old, new = _run("old", args), _run("new", args)
+    print(f"Фото: {len(paths)}, альбом по {args.album}")
+    for name, res in (("old", old), ("new", new)):
+        print(f"{name}: {res['elapsed']:.2f}s ({res['elapsed'] / len(paths) * 1000:.0f} ms/фото), "
+              f"пик RSS процесса {res['maxrss_kb'] / 1024:.0f} MB")
+
+    common = [p for p in paths if p in old["metrics"] and p in new["metrics"]]
+    agree = sum(1 for p in common if _is_likely_document(*old["metrics"][p][:3]) == _is_likely_document(*new["metrics"][p][:3]))
+    print(f"Совпадение решений документ/не документ: {agree}/{len(common)}")
+    for p in common:
+        o, n = old["metrics"][p], new["metrics"][p]
+        mark = "≠" if _is_likely_document(*o[:3]) != _is_likely_document(*n[:3]) else " "
+        print(f"  {mark} {os.path.basename(p)} {o[3]}x{o[4]}: old entropy={o[0]:.2f} edges={o[1]:.2f} white={o[2]:.2f} | "
+              f"new entropy={n[0]:.2f} edges={n[1]:.2f} white={n[2]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
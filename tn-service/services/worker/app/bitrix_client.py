@@ -1,91 +1,304 @@
 import os
-import json
-import base64
-import urllib.request
+import io
+import threading
+import time
 import urllib.parse
-import urllib.error
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Tuple, Dict, Any, List
+import requests
+from requests.adapters import HTTPAdapter
+from . import metrics
+from .rate_limit import TokenBucket
 
 BITRIX_WEBHOOK_URL = os.getenv("BITRIX_WEBHOOK_URL", "").rstrip("/") + "/"
 BITRIX_METHOD = os.getenv("BITRIX_METHOD", "im.message.add")
 BITRIX_CHAT_ID = os.getenv("BITRIX_CHAT_ID", "chat0")
+BITRIX_TIMEOUT = float(os.getenv("BITRIX_TIMEOUT", "45"))
+# Сколько фото одной выгрузки грузим на диск параллельно; публикация в чат — строго по порядку.
+BITRIX_UPLOAD_CONCURRENCY = int(os.getenv("BITRIX_UPLOAD_CONCURRENCY", "4"))
+BITRIX_FOLDER_TTL = float(os.getenv("BITRIX_FOLDER_TTL", "3600"))
+UPLOAD_CHUNK = 64 * 1024
+# Квота вебхука Bitrix24 (~2 запроса/с с небольшим запасом) — общая для всех процессов через Redis.
+BITRIX_RATE = float(os.getenv("BITRIX_RATE", "2"))
+BITRIX_BURST = float(os.getenv("BITRIX_BURST", "10"))
+BITRIX_LIMIT_RETRIES = int(os.getenv("BITRIX_LIMIT_RETRIES", "5"))
+BATCH_MAX_COMMANDS = 50
+
+LIMITER = TokenBucket("bitrix", BITRIX_RATE, BITRIX_BURST)
+
+# Keep-alive сессия на процесс вместо нового соединения urllib на каждый вызов REST.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(BITRIX_UPLOAD_CONCURRENCY * 2, 4)))
+
+_upload_pool = ThreadPoolExecutor(max_workers=BITRIX_UPLOAD_CONCURRENCY, thread_name_prefix="bitrix-upload")
+_folders: Dict[int, Tuple[int, float]] = {}
+_folders_lock = threading.Lock()
+
+
+def _post(url: str, **kwargs) -> requests.Response:
+    LIMITER.acquire()
+    return SESSION.post(url, timeout=BITRIX_TIMEOUT, **kwargs)
 
 def _call(method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     url = BITRIX_WEBHOOK_URL + method
-    data = urllib.parse.urlencode(payload, doseq=True).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/x-www-form-urlencoded"})
-    
-    try:
-        with urllib.request.urlopen(req, timeout=45) as r:
-            raw = r.read().decode("utf-8", errors="replace")
-        return json.loads(raw)
-    except urllib.error.HTTPError as e:
-        raw = e.read().decode("utf-8", errors="replace")
+    for attempt in range(1, BITRIX_LIMIT_RETRIES + 1):
         try:
-            return json.loads(raw)
-        except Exception:
-            return {"error": f"HTTP {e.code}", "error_description": raw}
-    except Exception as e:
-        return {"error": "Request Failed", "error_description": str(e)}
+            r = _post(url, data=payload)
+        except Exception as e:
+            return {"error": "Request Failed", "error_description": str(e)}
+        try:
+            resp = r.json()
+        except ValueError:
+            return {"error": f"HTTP {r.status_code}", "error_description": r.text}
+        # Портал всё равно ответил "слишком часто" (квоту делят и другие интеграции) — ждём и повторяем.
+        if resp.get("error") != "QUERY_LIMIT_EXCEEDED" or attempt == BITRIX_LIMIT_RETRIES:
+            return resp
+        metrics.incr("bitrix.query_limit_exceeded")
+        time.sleep(min(30.0, 1.0 * 2 ** (attempt - 1)))
+    return resp
+
+def _batch(commands: List[Tuple[str, str, Dict[str, Any]]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Выполняет (ключ, метод, параметры) через REST batch — до 50 команд за один запрос.
+    halt=1: команды идут по порядку и останавливаются на первой ошибке. Возвращает (результаты, ошибки) по ключам.
+    """
+    results, errors = {}, {}
+    for i in range(0, len(commands), BATCH_MAX_COMMANDS):
+        chunk = commands[i:i + BATCH_MAX_COMMANDS]
+        payload = {"halt": 1}
+        for key, method, params in chunk:
+            payload[f"cmd[{key}]"] = f"{method}?{urllib.parse.urlencode(params)}"
+        resp = _call("batch", payload)
+        if "error" in resp:
+            errors.update({key: resp for key, _, _ in chunk})
+            break
+        body = resp.get("result") or {}
+        results.update(body.get("result") or {})
+        errors.update(body.get("result_error") or {})
+        if errors:
+            break
+    return results, errors
 
 def _chat_numeric_id(chat_id: str) -> int:
     digits = "".join([c for c in (chat_id or "") if c.isdigit()])
     return int(digits or "0")
 
+def target_chat_id() -> int:
+    return _chat_numeric_id(BITRIX_CHAT_ID)
+
 def _get_chat_folder_id(chat_num_id: int) -> int:
+    # Папка чата на диске не меняется — кэшируем id; при ошибке загрузки запись сбрасывается.
+    with _folders_lock:
+        cached = _folders.get(chat_num_id)
+    if cached and cached[1] > time.monotonic():
+        metrics.incr("bitrix.folder.cache_hit")
+        return cached[0]
     resp = _call("im.disk.folder.get", {"CHAT_ID": chat_num_id})
     result = resp.get("result") or {}
     folder_id = int(result.get("ID") or 0)
     if not folder_id:
         raise RuntimeError(f"im.disk.folder.get failed: {resp}")
+    with _folders_lock:
+        _folders[chat_num_id] = (folder_id, time.monotonic() + BITRIX_FOLDER_TTL)
     return folder_id
 
+def _forget_chat_folder(chat_num_id: int):
+    with _folders_lock:
+        _folders.pop(chat_num_id, None)
+
+
+class _MultipartFile:
+    """
+    Тело multipart/form-data с одним файлом, которое читается с диска кусками по мере отправки.
+    Длина известна заранее, поэтому запрос уходит с Content-Length, а не chunked.
+    """
+
+    def __init__(self, field: str, path: str, filename: str):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._parts = [
+            io.BytesIO(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n".encode("utf-8")
+            ),
+            open(path, "rb"),
+            io.BytesIO(f"\r\n--{self.boundary}--\r\n".encode("ascii")),
+        ]
+        self._len = len(self._parts[0].getvalue()) + os.path.getsize(path) + len(self._parts[2].getvalue())
+
+    def __len__(self):
+        return self._len
+
+    def read(self, size: int = -1) -> bytes:
+        size = UPLOAD_CHUNK if size is None or size < 0 else size
+        while self._parts:
+            chunk = self._parts[0].read(size)
+            if chunk:
+                return chunk
+            self._parts.pop(0).close()
+        return b""
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(UPLOAD_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        for p in self._parts:
+            p.close()
+        self._parts = []
+
+
 def _upload_to_folder(folder_id: int, file_path: str) -> int:
+    # Двухшаговая загрузка disk.folder.uploadfile: получаем uploadUrl и стримим файл
+    # multipart-ом с диска, без base64 и копий фото в памяти.
     filename = os.path.basename(file_path)
-    with open(file_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("ascii")
-
-    resp = _call(
-        "disk.folder.uploadfile",
-        {
-            "id": folder_id,
-            "data[NAME]": filename,
-            "fileContent[0]": filename,
-            "fileContent[1]": b64,
-        },
-    )
+    resp = _call("disk.folder.uploadfile", {"id": folder_id, "data[NAME]": filename, "generateUniqueName": "Y"})
     result = resp.get("result") or {}
+    upload_url = result.get("uploadUrl")
+    if not upload_url:
+        raise RuntimeError(f"disk.folder.uploadfile failed: {resp}")
+
+    body = _MultipartFile(result.get("field") or "file", file_path, filename)
+    try:
+        r = _post(upload_url, data=body, headers={"Content-Type": body.content_type})
+    finally:
+        body.close()
+    metrics.incr("bitrix.upload.bytes", len(body))
+    try:
+        uploaded = r.json()
+    except ValueError:
+        raise RuntimeError(f"upload HTTP {r.status_code}: {r.text[:200]}")
+    result = uploaded.get("result") or {}
     disk_id = int(result.get("ID") or result.get("id") or 0)
     if not disk_id:
-        raise RuntimeError(f"disk.folder.uploadfile failed: {resp}")
+        raise RuntimeError(f"disk upload failed: {uploaded}")
     return disk_id
 
-def _commit_file_to_chat(chat_num_id: int, disk_id: int) -> Dict[str, Any]:
-    return _call("im.disk.file.commit", {"CHAT_ID": chat_num_id, "DISK_ID": disk_id})
 
-def send_to_bitrix_sync(text: str, photo_paths: List[str] = None) -> Tuple[bool, Dict[str, Any], str, Dict[str, Any]]:
-    payload_for_db: Dict[str, Any] = {"text": text, "photo_paths": photo_paths}
+def _timed(step: str, timings: Dict[str, float], fn, *args):
+    started = time.monotonic()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.observe(f"bitrix.{step}.seconds", elapsed)
+        timings[step] = round(timings.get(step, 0.0) + elapsed, 3)
+
+
+def upload_photos(chat_num_id: int, paths: List[str], uploaded: Dict[int, int], on_uploaded, timings: Dict[str, float]) -> List[int]:
+    """
+    Загружает на диск фото, которых ещё нет в uploaded ({номер фото: disk_id}); on_uploaded(i, disk_id)
+    вызывается для каждой новой загрузки. Возвращает disk_id всех фото в исходном порядке.
+    """
+    missing = [i for i in range(len(paths)) if i not in uploaded]
+    if not missing:
+        return [uploaded[i] for i in range(len(paths))]
+    folder_id = _timed("folder", timings, _get_chat_folder_id, chat_num_id)
+
+    def upload(path):
+        started = time.monotonic()
+        try:
+            return _upload_to_folder(folder_id, path)
+        finally:
+            metrics.observe("bitrix.upload.seconds", time.monotonic() - started)
+
+    started = time.monotonic()
+    futures = {i: _upload_pool.submit(upload, paths[i]) for i in missing}
+    first_error = None
+    for i in missing:
+        # Дожидаемся всех загрузок: успешные фиксируются, даже если соседняя упала.
+        try:
+            uploaded[i] = futures[i].result()
+            on_uploaded(i, uploaded[i])
+        except Exception as e:
+            first_error = first_error or e
+    timings["upload"] = round(timings.get("upload", 0.0) + time.monotonic() - started, 3)
+    if first_error:
+        # Папку могли удалить или пересоздать — следующая попытка запросит id заново.
+        _forget_chat_folder(chat_num_id)
+        raise first_error
+    return [uploaded[i] for i in range(len(paths))]
+
+
+def publish(chat_num_id: int, disk_ids: List[int], committed: int, text: Optional[str], timings: Dict[str, float]) -> Tuple[int, Any, str]:
+    """
+    Публикует в чат фото disk_ids[committed:] по порядку и затем текст (если text не None) одним batch.
+    Возвращает (сколько фото опубликовано всего, id сообщения или None, ошибка или "").
+    """
+    commands = [(f"commit{i}", "im.disk.file.commit", {"CHAT_ID": chat_num_id, "DISK_ID": disk_ids[i]}) for i in range(committed, len(disk_ids))]
+    if text is not None:
+        commands.append(("message", BITRIX_METHOD, {"DIALOG_ID": BITRIX_CHAT_ID, "MESSAGE": text}))
+    if not commands:
+        return committed, None, ""
+    results, errors = _timed("publish", timings, _batch, commands)
+    while committed < len(disk_ids) and f"commit{committed}" in results:
+        committed += 1
+    err_msg = ""
+    if errors:
+        key, err = next(iter(errors.items()))
+        err_msg = f'{key}: {err.get("error")}: {err.get("error_description")}' if isinstance(err, dict) else f"{key}: {err}"
+    return committed, results.get("message"), err_msg
 
+
+def export_paths(photo_paths: Optional[List[str]]) -> List[str]:
+    return [p.strip() for p in (photo_paths or []) if p.strip() and os.path.exists(p.strip())]
+
+
+_PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+RSS_SAMPLE_INTERVAL = float(os.getenv("BITRIX_RSS_SAMPLE_INTERVAL", "0.05"))
+
+
+def _current_rss_kb() -> Optional[int]:
+    # Текущий (а не пиковый за жизнь процесса, как ru_maxrss) резидентный размер.
     try:
-        chat_num_id = _chat_numeric_id(BITRIX_CHAT_ID)
-        
-        # 1) СНАЧАЛА загружаем и публикуем ФОТО по одному
-        if photo_paths:
-            folder_id = _get_chat_folder_id(chat_num_id)
-            for path in photo_paths:
-                clean_path = path.strip()
-                if clean_path and os.path.exists(clean_path):
-                    disk_id = _upload_to_folder(folder_id, clean_path)
-                    _commit_file_to_chat(chat_num_id, disk_id)
-
-        # 2) ПОТОМ отправляем ТЕКСТ (он будет под фотографиями)
-        resp = _call(BITRIX_METHOD, {"DIALOG_ID": BITRIX_CHAT_ID, "MESSAGE": text})
-        
-        if "error" in resp:
-            err_msg = f'{resp.get("error")}: {resp.get("error_description")}'
-            return False, resp, err_msg, payload_for_db
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_KB
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class measure_export:
+    """
+    Шаговые тайминги и прирост памяти процесса за время одной выгрузки: текущий RSS снимается
+    до начала и периодически во время выгрузки, в метрику идёт максимум прироста.
+    Другие слоты воркера в это время тоже могут расходовать память — значение оценочное.
+    """
+
+    def __init__(self, timings: Dict[str, float], photos: int):
+        self.timings = timings
+        self.photos = photos
+
+    def _sample(self):
+        while not self._done.wait(RSS_SAMPLE_INTERVAL):
+            rss = _current_rss_kb()
+            if rss is not None:
+                self.rss_peak = max(self.rss_peak, rss)
 
-        return True, resp, "", payload_for_db
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.rss_before = _current_rss_kb()
+        self.rss_peak = self.rss_before or 0
+        self._done = threading.Event()
+        self._sampler = None
+        if self.rss_before is not None:
+            self._sampler = threading.Thread(target=self._sample, name="bitrix-rss", daemon=True)
+            self._sampler.start()
+        return self.timings
 
-    except Exception as e:
-        return False, {}, repr(e), payload_for_db
+    def __exit__(self, *exc):
+        self._done.set()
+        if self._sampler:
+            self._sampler.join()
+        self.timings["total"] = round(time.monotonic() - self.started, 3)
+        metrics.observe("bitrix.export.seconds", self.timings["total"])
+        if self.rss_before is None:
+            print(f"📤 [BITRIX] {self.photos} фото, шаги {self.timings}", flush=True)
+            return False
+        rss_growth = max(0, max(self.rss_peak, _current_rss_kb() or 0) - self.rss_before)
+        metrics.gauge("bitrix.export.rss_growth_kb", rss_growth)
+        print(f"📤 [BITRIX] {self.photos} фото, шаги {self.timings}, прирост RSS до {rss_growth} КБ", flush=True)
+        return False
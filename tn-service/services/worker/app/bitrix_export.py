@@ -0,0 +1,82 @@
+import os, time
+from typing import Any, Dict, Optional, Tuple
+from . import bitrix_client, metrics, task_queue
+from .db import upsert_export, claim_export, save_export_steps, finish_export, fail_export, due_exports, set_confirmed, set_bitrix_result
+
+# Выгрузка документа в Битрикс через outbox (таблица bitrix_exports). Каждый шаг —
+# загрузка фото на диск, публикация в чат, текст — записывается сразу после выполнения,
+# поэтому повтор после сбоя не дублирует уже опубликованные фото и сообщение.
+BITRIX_EXPORT_MAX_ATTEMPTS = int(os.getenv("BITRIX_EXPORT_MAX_ATTEMPTS", "12"))
+BITRIX_EXPORT_RETRY_BASE = float(os.getenv("BITRIX_EXPORT_RETRY_BASE", "30"))
+BITRIX_EXPORT_RETRY_MAX = float(os.getenv("BITRIX_EXPORT_RETRY_MAX", "1800"))
+BITRIX_DRAIN_INTERVAL = float(os.getenv("BITRIX_DRAIN_INTERVAL", "30"))
+BITRIX_DRAIN_BATCH = int(os.getenv("BITRIX_DRAIN_BATCH", "10"))
+
+
+def idempotency_key(doc_id) -> str:
+    return f"doc:{doc_id}"
+
+
+def create(doc_id, text, photo_paths, platform, chat_id, mid) -> Dict[str, Any]:
+    paths = bitrix_client.export_paths(photo_paths)
+    return upsert_export(doc_id, idempotency_key(doc_id), text, ",".join(paths), platform, chat_id, mid)
+
+
+def _retry_delay(attempts: int) -> Optional[float]:
+    if attempts >= BITRIX_EXPORT_MAX_ATTEMPTS:
+        return None
+    return min(BITRIX_EXPORT_RETRY_MAX, BITRIX_EXPORT_RETRY_BASE * 2 ** (attempts - 1))
+
+
+def run(export_id) -> Optional[Tuple[Dict[str, Any], bool, str]]:
+    """Выполняет оставшиеся шаги выгрузки. None — выгрузку уже ведёт другой воркер или она завершена."""
+    row = claim_export(export_id)
+    if not row:
+        return None
+    steps = dict(row["steps"] or {})
+    paths = [p for p in (row["photo_paths"] or "").split(",") if p]
+    uploaded = {int(k): v for k, v in (steps.get("disk_ids") or {}).items()}
+    timings: Dict[str, float] = {}
+
+    def on_uploaded(i, disk_id):
+        steps.setdefault("disk_ids", {})[str(i)] = disk_id
+        save_export_steps(export_id, steps)
+
+    with bitrix_client.measure_export(timings, len(paths)):
+        try:
+            chat_num_id = bitrix_client.target_chat_id()
+            disk_ids = bitrix_client.upload_photos(chat_num_id, paths, uploaded, on_uploaded, timings)
+            text = None if "message_id" in steps else row["text"]
+            committed, message_id, err = bitrix_client.publish(chat_num_id, disk_ids, steps.get("committed", 0), text, timings)
+            steps["committed"] = committed
+            if message_id is not None:
+                steps["message_id"] = message_id
+            if err:
+                raise RuntimeError(err)
+        except Exception as e:
+            err = str(e)
+            retry_in = _retry_delay(row["attempts"] + 1)
+            metrics.incr("bitrix.export.retry" if retry_in is not None else "bitrix.export.failed")
+            print(f"❌ [BITRIX] Выгрузка #{export_id} (документ {row['doc_id']}), попытка {row['attempts'] + 1}: {err}"
+                  + (f"; повтор через {retry_in:.0f}s" if retry_in is not None else "; попытки исчерпаны"), flush=True)
+            return fail_export(export_id, steps, err, retry_in), False, err
+
+    finish_export(export_id, steps)
+    set_confirmed(row["doc_id"])
+    set_bitrix_result(row["doc_id"], str(steps.get("message_id", "")), "success")
+    metrics.incr("bitrix.export.done")
+    return row, True, ""
+
+
+_next_drain = 0.0
+
+
+def drain(rds):
+    """Ставит в очередь созревшие повторы и выгрузки, чья задача потерялась (вызывается из housekeeping)."""
+    global _next_drain
+    if time.monotonic() < _next_drain:
+        return
+    _next_drain = time.monotonic() + BITRIX_DRAIN_INTERVAL
+    for row in due_exports(BITRIX_DRAIN_BATCH):
+        task_queue.enqueue(rds, {"type": "bitrix_export", "export_id": row["id"], "doc_id": row["doc_id"]})
+        metrics.incr("bitrix.export.drained")
@@ -19,3 +19,5 @@ MIN_CONFIDENCE = float(os.getenv("MIN_CONFIDENCE", "0.70"))
 API_BASE = f"https://api.telegram.org/bot{BOT_TOKEN}" if BOT_TOKEN else None
 FILE_BASE = f"https://api.telegram.org/file/bot{BOT_TOKEN}" if BOT_TOKEN else None
 DOWNLOAD_DIR = "/tmp/photos"
+# Сколько фото одного альбома скачиваем параллельно (размер пула соединений — PLATFORM_POOL_SIZE в platform_http).
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "6"))
@@ -1,46 +1,71 @@
-import json, os
-import psycopg
+import json, os, threading
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
 try:
     from .config import DATABASE_URL
 except ImportError:
     DATABASE_URL = os.getenv("DATABASE_URL", "").replace("DATABASE_URL=", "").strip("'\"")
 
-def connect():
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+# Общий пул соединений на процесс вместо нового TCP+auth на каждый запрос.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# С какого повторения запрос готовится на сервере (server-side prepared statement).
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "2"))
+# Сколько выгрузка в Битрикс может считаться "в работе", прежде чем её подберёт другой воркер.
+EXPORT_LEASE_SECONDS = int(os.getenv("BITRIX_EXPORT_LEASE", "900"))
 
-def init_db():
-    with connect() as conn:
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS transport_documents (
-          id BIGSERIAL PRIMARY KEY,
-          telegram_chat_id BIGINT,
-          telegram_file_id TEXT,
-          photo_path TEXT,
-          ocr_data JSONB,
-          ocr_raw TEXT,
-          confidence FLOAT,
-          status TEXT,
-          error_reason TEXT,
-          created_at TIMESTAMP DEFAULT now(),
-          updated_at TIMESTAMP DEFAULT now(),
-          bitrix_deal_id TEXT,
-          bitrix_status TEXT,
-          confirmed_at TIMESTAMP
-        );
-        """)
-        conn.commit()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                kwargs={"row_factory": dict_row, "prepare_threshold": DB_PREPARE_THRESHOLD},
+                check=ConnectionPool.check_connection,
+                max_idle=300,
+                name="worker",
+                open=True,
+            )
+        return _pool
+
+
+def pool_stats():
+    return get_pool().get_stats() if _pool is not None else {}
+
+
+def connect():
+    return get_pool().connection()
 
-def insert_received(chat_id, file_id, photo_path):
+def insert_received(chat_id, file_id, photo_path, task_id=None):
+    """
+    Заводит документ для задачи распознавания. С task_id повторная доставка той же задачи
+    возвращает уже созданный документ: (doc_id, False), новая — (doc_id, True).
+    """
     with connect() as conn:
+        if task_id:
+            # Конкурентная вставка того же task_id ждёт коммита первой и получает конфликт.
+            cur = conn.execute("INSERT INTO batch_tasks (task_id) VALUES (%s) ON CONFLICT (task_id) DO NOTHING RETURNING task_id", (task_id,))
+            if cur.fetchone() is None:
+                row = conn.execute("SELECT doc_id FROM batch_tasks WHERE task_id=%s", (task_id,)).fetchone()
+                conn.commit()
+                if row and row["doc_id"]:
+                    return row["doc_id"], False
         cur = conn.execute(
             "INSERT INTO transport_documents (telegram_chat_id, telegram_file_id, photo_path, status) VALUES (%s,%s,%s,'received') RETURNING id",
             (chat_id, file_id, photo_path),
         )
         doc_id = cur.fetchone()["id"]
+        if task_id:
+            conn.execute("UPDATE batch_tasks SET doc_id=%s WHERE task_id=%s", (doc_id, task_id))
         conn.commit()
-        return doc_id
+        return doc_id, True
 
 def update_ocr(doc_id, data, raw, conf, status, reason):
     with connect() as conn:
@@ -56,7 +81,12 @@ def update_ocr(doc_id, data, raw, conf, status, reason):
 
 def get_doc(doc_id):
     with connect() as conn:
-        return conn.execute("SELECT * FROM transport_documents WHERE id=%s", (doc_id,)).fetchone()
+        return conn.execute(
+            "SELECT *, (SELECT COALESCE(jsonb_agg(jsonb_build_object('type', e.type, 'date', e.event_date) ORDER BY e.id), '[]'::jsonb) "
+            "FROM operation_events e WHERE e.doc_id = transport_documents.id) AS operation_events "
+            "FROM transport_documents WHERE id=%s",
+            (doc_id,),
+        ).fetchone()
 
 def set_confirmed(doc_id):
     with connect() as conn:
@@ -67,3 +97,94 @@ def set_bitrix_result(doc_id, deal_id, status):
     with connect() as conn:
         conn.execute("UPDATE transport_documents SET bitrix_deal_id=%s, bitrix_status=%s WHERE id=%s", (deal_id, status, doc_id))
         conn.commit()
+
+# Outbox выгрузок в Битрикс (таблица bitrix_exports): состояние каждого шага переживает
+# падение воркера и недоступность Битрикса, повтор продолжает с последнего выполненного шага.
+def upsert_export(doc_id, key, text, photo_paths, platform, chat_id, mid):
+    # Повторное нажатие "Подтвердить" не создаёт вторую выгрузку: завершённая остаётся done,
+    # отложенная/проваленная ставится в очередь заново. Текст обновляем, пока сообщение не отправлено.
+    # Пока идёт попытка (аренда не истекла), сообщение для результата не меняем: его обновит она.
+    with connect() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO bitrix_exports (doc_id, idempotency_key, text, photo_paths, platform, chat_id, mid, next_attempt_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, now() + %s * interval '1 second')
+            ON CONFLICT (idempotency_key) DO UPDATE SET
+              text = CASE WHEN bitrix_exports.steps ? 'message_id' THEN bitrix_exports.text ELSE EXCLUDED.text END,
+              platform = CASE WHEN bitrix_exports.state = 'in_progress' AND bitrix_exports.locked_until > now() THEN bitrix_exports.platform ELSE EXCLUDED.platform END,
+              chat_id = CASE WHEN bitrix_exports.state = 'in_progress' AND bitrix_exports.locked_until > now() THEN bitrix_exports.chat_id ELSE EXCLUDED.chat_id END,
+              mid = CASE WHEN bitrix_exports.state = 'in_progress' AND bitrix_exports.locked_until > now() THEN bitrix_exports.mid ELSE EXCLUDED.mid END,
+              state = CASE WHEN bitrix_exports.state IN ('retry', 'failed') THEN 'pending' ELSE bitrix_exports.state END,
+              attempts = CASE WHEN bitrix_exports.state = 'failed' THEN 0 ELSE bitrix_exports.attempts END,
+              next_attempt_at = EXCLUDED.next_attempt_at,
+              updated_at = now()
+            RETURNING *
+            """,
+            (doc_id, key, text, photo_paths, platform, str(chat_id) if chat_id is not None else None,
+             str(mid) if mid is not None else None, EXPORT_LEASE_SECONDS),
+        ).fetchone()
+        conn.commit()
+        return row
+
+def claim_export(export_id):
+    with connect() as conn:
+        row = conn.execute(
+            """
+            UPDATE bitrix_exports SET state='in_progress', locked_until = now() + %s * interval '1 second', updated_at=now()
+            WHERE id=%s AND (state IN ('pending', 'retry') OR (state='in_progress' AND locked_until < now()))
+            RETURNING *
+            """,
+            (EXPORT_LEASE_SECONDS, export_id),
+        ).fetchone()
+        conn.commit()
+        return row
+
+def save_export_steps(export_id, steps):
+    with connect() as conn:
+        conn.execute(
+            "UPDATE bitrix_exports SET steps=%s::jsonb, updated_at=now() WHERE id=%s",
+            (json.dumps(steps), export_id),
+        )
+        conn.commit()
+
+def finish_export(export_id, steps):
+    with connect() as conn:
+        conn.execute(
+            "UPDATE bitrix_exports SET state='done', steps=%s::jsonb, last_error=NULL, locked_until=NULL, finished_at=now(), updated_at=now() WHERE id=%s",
+            (json.dumps(steps), export_id),
+        )
+        conn.commit()
+
+def fail_export(export_id, steps, error, retry_in):
+    # retry_in=None — попытки исчерпаны, выгрузка остаётся failed до ручного повтора.
+    with connect() as conn:
+        row = conn.execute(
+            """
+            UPDATE bitrix_exports SET state = CASE WHEN %s::float IS NULL THEN 'failed' ELSE 'retry' END,
+              steps=%s::jsonb, last_error=%s, attempts=attempts+1, locked_until=NULL,
+              next_attempt_at = now() + COALESCE(%s::float, 0) * interval '1 second', updated_at=now()
+            WHERE id=%s RETURNING *
+            """,
+            (retry_in, json.dumps(steps), error, retry_in, export_id),
+        ).fetchone()
+        conn.commit()
+        return row
+
+def due_exports(limit):
+    # Забираем созревшие выгрузки и сдвигаем им next_attempt_at на время аренды, чтобы не поставить их в очередь дважды.
+    with connect() as conn:
+        rows = conn.execute(
+            """
+            UPDATE bitrix_exports SET next_attempt_at = now() + %s * interval '1 second'
+            WHERE id IN (
+              SELECT id FROM bitrix_exports
+              WHERE state IN ('pending', 'retry', 'in_progress') AND next_attempt_at <= now()
+                AND (state <> 'in_progress' OR locked_until < now())
+              ORDER BY next_attempt_at LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, doc_id
+            """,
+            (EXPORT_LEASE_SECONDS, limit),
+        ).fetchall()
+        conn.commit()
+        return rows
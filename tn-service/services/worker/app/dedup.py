@@ -0,0 +1,100 @@
+import os
+from typing import Any, Dict, List
+import redis
+from PIL import Image
+from .config import REDIS_URL
+from . import metrics
+
+# Поиск почти одинаковых кадров по dHash: водитель часто снимает одну страницу 2–3 раза.
+PHASH_MAX_DISTANCE = int(os.getenv("OCR_PHASH_MAX_DISTANCE", "6"))
+PHASH_RECENT_LIMIT = int(os.getenv("OCR_PHASH_RECENT_LIMIT", "50"))
+PHASH_RECENT_TTL = int(os.getenv("OCR_PHASH_RECENT_TTL", str(24 * 3600)))
+
+RECENT_KEY = "ocr:phash:recent:{chat_id}"
+
+_rds = None
+
+
+def _client():
+    global _rds
+    if _rds is None:
+        _rds = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _rds
+
+
+def dhash(gray: Image.Image) -> int:
+    small = gray.resize((9, 8), Image.BOX)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = px[row * 9 + col], px[row * 9 + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return bits
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def item_hash(item: Dict[str, Any]) -> int:
+    if item.get("phash") is None:
+        item["phash"] = dhash(item["gray"])
+    return item["phash"]
+
+
+def drop_near_duplicates(items: List[Dict[str, Any]], sharpness) -> List[Dict[str, Any]]:
+    """Группирует почти одинаковые кадры и оставляет из каждой группы самый резкий (sharpness(item))."""
+    groups = []
+    for it in items:
+        h = item_hash(it)
+        for g in groups:
+            if distance(h, item_hash(g[0])) <= PHASH_MAX_DISTANCE:
+                g.append(it)
+                break
+        else:
+            groups.append([it])
+
+    kept = []
+    for g in groups:
+        best = max(g, key=sharpness)
+        kept.append(best)
+        for it in g:
+            if it is best:
+                continue
+            metrics.incr("ocr.dedup.dropped")
+            print(f"🪞 [OCR] Дубль страницы пропущен: {it['path']} (оставлен {best['path']}, "
+                  f"dist={distance(item_hash(it), item_hash(best))})", flush=True)
+    # Сохраняем исходный порядок страниц альбома.
+    order = {id(it): i for i, it in enumerate(items)}
+    return sorted(kept, key=lambda it: order[id(it)])
+
+
+def count_recent_repeats(chat_id, items: List[Dict[str, Any]]) -> int:
+    """
+    Считает страницы, которые этот чат уже присылал недавно, и обновляет индекс хэшей чата.
+    Только для наблюдения (лог и счётчик ocr.dedup.cross_batch_repeats): на распознавание не влияет.
+    """
+    if chat_id is None:
+        return 0
+    key = RECENT_KEY.format(chat_id=chat_id)
+    repeats = 0
+    try:
+        rds = _client()
+        recent = [int(h, 16) for h in rds.lrange(key, 0, -1)]
+        for it in items:
+            h = item_hash(it)
+            if any(distance(h, r) <= PHASH_MAX_DISTANCE for r in recent):
+                repeats += 1
+                print(f"🔁 [OCR] Страница уже присылалась в этот чат недавно: {it['path']}", flush=True)
+        pipe = rds.pipeline()
+        for it in items:
+            pipe.lpush(key, format(item_hash(it), "016x"))
+        pipe.ltrim(key, 0, PHASH_RECENT_LIMIT - 1)
+        pipe.expire(key, PHASH_RECENT_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ [OCR] Индекс хэшей недоступен: {e}", flush=True)
+    if repeats:
+        metrics.incr("ocr.dedup.cross_batch_repeats", repeats)
+    return repeats
@@ -0,0 +1,247 @@
+import io, os, threading
+from typing import Any, Dict, Optional
+from PIL import Image, ImageFilter, ImageOps
+
+# Фото декодируется один раз: из этого кадра считаются метрики "похожести на документ"
+# и собирается payload для OCR. JPEG декодируется сразу в уменьшенном draft-режиме.
+DECODE_MAX_EDGE = int(os.getenv("IMAGE_DECODE_MAX_EDGE", "2048"))
+# Сколько фото декодируется одновременно на процесс — отдельно от числа параллельных скачиваний:
+# пик памяти определяется декодированными кадрами, а не сетью.
+DECODE_CONCURRENCY = int(os.getenv("IMAGE_DECODE_CONCURRENCY", "2"))
+PAYLOAD_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "90"))
+
+# Профиль изображения для vision-модели. OCR_IMAGE_PROFILE=off — отправлять кадр как есть.
+OCR_IMAGE_PROFILE = os.getenv("OCR_IMAGE_PROFILE", "on").lower() not in ("0", "off", "false", "no")
+OCR_IMAGE_MAX_EDGE = int(os.getenv("OCR_IMAGE_MAX_EDGE", "2048"))
+OCR_IMAGE_GRAYSCALE = os.getenv("OCR_IMAGE_GRAYSCALE", "1") == "1"
+OCR_IMAGE_AUTOCONTRAST = os.getenv("OCR_IMAGE_AUTOCONTRAST", "1") == "1"
+OCR_IMAGE_AUTOCROP = os.getenv("OCR_IMAGE_AUTOCROP", "1") == "1"
+OCR_IMAGE_DESKEW = os.getenv("OCR_IMAGE_DESKEW", "1") == "1"
+OCR_IMAGE_TARGET_BYTES = int(os.getenv("OCR_IMAGE_TARGET_BYTES", "400000"))
+OCR_IMAGE_MIN_QUALITY = int(os.getenv("OCR_IMAGE_MIN_QUALITY", "50"))
+
+ANALYSIS_EDGE = 256
+DESKEW_MAX_ANGLE = 6.0
+DESKEW_STEP = 0.5
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+_decode_slots = threading.BoundedSemaphore(DECODE_CONCURRENCY)
+
+
+def normalize_download(raw: bytes) -> bytes:
+    """JPEG сохраняем как есть; прочие форматы (PNG, WEBP из MAX) один раз перекодируем в JPEG."""
+    if raw[:3] == JPEG_MAGIC:
+        return raw
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=95)
+            return buf.getvalue()
+    except Exception:
+        return raw
+
+
+def save_download(raw: bytes, local: str) -> bytes:
+    data = normalize_download(raw)
+    with open(local, "wb") as f:
+        f.write(data)
+    return data
+
+
+def load(path: str, raw: Optional[bytes] = None) -> Dict[str, Any]:
+    if raw is None:
+        with open(path, "rb") as f:
+            raw = f.read()
+
+    with _decode_slots:
+        img = Image.open(io.BytesIO(raw))
+        fmt = img.format
+        src_w, src_h = img.size
+        if fmt == "JPEG":
+            # draft() декодирует сразу в 1/2, 1/4 или 1/8 размера — самый мелкий масштаб не меньше запрошенного.
+            # Просим половину предела: 4000×3000 декодируется в 2000×1500, а не в полный размер.
+            draft_edge = max(1, DECODE_MAX_EDGE // 2)
+            ratio = draft_edge / max(src_w, src_h, 1)
+            if ratio < 1.0:
+                img.draft("RGB", (max(1, int(src_w * ratio)), max(1, int(src_h * ratio))))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # in_place: без лишней полноразмерной копии, если ориентация уже правильная.
+        ImageOps.exif_transpose(img, in_place=True)
+        if max(img.size) > DECODE_MAX_EDGE:
+            img.thumbnail((DECODE_MAX_EDGE, DECODE_MAX_EDGE), Image.LANCZOS)
+        gray = img.convert("L")
+
+    return {
+        "path": path,
+        "raw": raw,
+        "format": fmt,
+        "source_size": (src_w, src_h),
+        "image": img,
+        "gray": gray,
+        "metrics": None,
+        "ocr_geometry": None,
+    }
+
+
+def analysis_gray(raw: bytes, max_edge: int) -> Image.Image:
+    """Отдельное уменьшенное декодирование в оттенках серого: длинная сторона не больше max_edge."""
+    with _decode_slots:
+        img = Image.open(io.BytesIO(raw))
+        src_w, src_h = img.size
+        ratio = max_edge / max(src_w, src_h, 1)
+        if img.format == "JPEG" and ratio < 1.0:
+            # libjpeg сразу отдаёт яркость в масштабе 1/2..1/8, не меньше max_edge.
+            img.draft("L", (max(1, int(src_w * ratio)), max(1, int(src_h * ratio))))
+        gray = img.convert("L") if img.mode != "L" else img
+        if max(gray.size) > max_edge:
+            gray.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        gray.load()
+        return gray
+
+
+def failed(path: str) -> Dict[str, Any]:
+    return {"path": path, "raw": None, "format": None, "source_size": (0, 0), "image": None, "gray": None, "metrics": None, "ocr_geometry": None}
+
+
+def payload_bytes(item: Dict[str, Any]) -> bytes:
+    # Исходный JPEG без изменений размера уходит как есть, без повторного кодирования.
+    if item["format"] == "JPEG" and item["image"].size == item["source_size"]:
+        return item["raw"]
+    buf = io.BytesIO()
+    item["image"].save(buf, "JPEG", quality=PAYLOAD_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def _small(gray: Image.Image) -> Image.Image:
+    thumb = gray.copy()
+    thumb.thumbnail((ANALYSIS_EDGE, ANALYSIS_EDGE), Image.BILINEAR)
+    return thumb
+
+
+def document_bbox(gray: Image.Image):
+    """Границы светлого листа на более тёмном фоне; None, если лист не выделяется."""
+    small = _small(gray).filter(ImageFilter.MedianFilter(5))
+    hist = small.histogram()
+    total = max(sum(hist), 1)
+    mean = sum(i * c for i, c in enumerate(hist)) / total
+    mask = small.point(lambda p: 255 if p > mean else 0).filter(ImageFilter.MinFilter(5))
+    box = mask.getbbox()
+    if not box:
+        return None
+    sx, sy = gray.size[0] / small.size[0], gray.size[1] / small.size[1]
+    pad = 4
+    x0, y0 = max(0, (box[0] - pad) * sx), max(0, (box[1] - pad) * sy)
+    x1, y1 = min(gray.size[0], (box[2] + pad) * sx), min(gray.size[1], (box[3] + pad) * sy)
+    area = (x1 - x0) * (y1 - y0) / float(gray.size[0] * gray.size[1])
+    # Слишком маленькая или почти полная область — обрезка не поможет или ошибочна.
+    if area < 0.3 or area > 0.95:
+        return None
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def _row_profile_score(ink: Image.Image) -> float:
+    # Средняя "чернильность" по строкам: у ровного текста строки и межстрочья сильно различаются.
+    rows = list(ink.resize((1, ink.size[1]), Image.BOX).getdata())
+    mean = sum(rows) / max(len(rows), 1)
+    return sum((r - mean) ** 2 for r in rows)
+
+
+def skew_angle(gray: Image.Image) -> float:
+    small = _small(gray)
+    ink = ImageOps.autocontrast(small).point(lambda p: 255 if p < 128 else 0)
+    best_angle, best_score = 0.0, _row_profile_score(ink)
+    steps = int(DESKEW_MAX_ANGLE / DESKEW_STEP)
+    for i in range(-steps, steps + 1):
+        angle = i * DESKEW_STEP
+        if not angle:
+            continue
+        score = _row_profile_score(ink.rotate(angle, resample=Image.NEAREST, fillcolor=0))
+        if score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle
+
+
+def ocr_geometry(item: Dict[str, Any]):
+    """Обрезка по листу и угол выравнивания, посчитанные по декодированному кадру (кэшируются в item)."""
+    if item.get("ocr_geometry") is None:
+        box = document_bbox(item["gray"]) if OCR_IMAGE_AUTOCROP else None
+        angle = 0.0
+        if OCR_IMAGE_DESKEW:
+            angle = skew_angle(item["gray"].crop(box) if box else item["gray"])
+        item["ocr_geometry"] = (box, angle)
+    return item["ocr_geometry"]
+
+
+def _apply_geometry(img: Image.Image, geometry, scale: float) -> Image.Image:
+    box, angle = geometry
+    if box:
+        img = img.crop(tuple(int(v * scale) for v in box))
+    if angle:
+        fill = 255 if img.mode == "L" else (255, 255, 255)
+        img = img.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=fill)
+    return img
+
+
+def ocr_frame(item: Dict[str, Any]) -> Image.Image:
+    img = item["gray"] if OCR_IMAGE_GRAYSCALE else item["image"]
+    img = _apply_geometry(img, ocr_geometry(item), 1.0)
+    if max(img.size) > OCR_IMAGE_MAX_EDGE:
+        img = img.copy()
+        img.thumbnail((OCR_IMAGE_MAX_EDGE, OCR_IMAGE_MAX_EDGE), Image.LANCZOS)
+    if OCR_IMAGE_AUTOCONTRAST:
+        img = ImageOps.autocontrast(img, cutoff=1)
+    return img
+
+
+def full_resolution_frame(item: Dict[str, Any]) -> Image.Image:
+    """Тот же кадр, что видела модель (обрезка/выравнивание), но из исходного файла в полном разрешении."""
+    with Image.open(io.BytesIO(item["raw"])) as src:
+        full = ImageOps.exif_transpose(src.convert("RGB"))
+    if not OCR_IMAGE_PROFILE:
+        return full
+    if OCR_IMAGE_GRAYSCALE:
+        full = full.convert("L")
+    scale = full.size[0] / float(item["image"].size[0])
+    return _apply_geometry(full, ocr_geometry(item), scale)
+
+
+def region_crop(item: Dict[str, Any], box, pad: float = 0.04, max_edge: int = 2048) -> bytes:
+    """JPEG-вырезка области страницы; box — нормированные [x0, y0, x1, y1] в кадре, который видела модель."""
+    frame = full_resolution_frame(item)
+    w, h = frame.size
+    x0, y0, x1, y1 = [min(1.0, max(0.0, float(v))) for v in box]
+    x0, x1 = sorted((x0, x1))
+    y0, y1 = sorted((y0, y1))
+    crop = frame.crop((int(max(0.0, x0 - pad) * w), int(max(0.0, y0 - pad) * h),
+                       int(min(1.0, x1 + pad) * w), int(min(1.0, y1 + pad) * h)))
+    if max(crop.size) > max_edge:
+        crop.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if OCR_IMAGE_AUTOCONTRAST:
+        crop = ImageOps.autocontrast(crop, cutoff=1)
+    buf = io.BytesIO()
+    crop.save(buf, "JPEG", quality=PAYLOAD_JPEG_QUALITY)
+    return buf.getvalue()
+
+
+def encode_within_budget(img: Image.Image, target_bytes: int) -> bytes:
+    # Сначала снижаем качество JPEG, затем, если не хватило, уменьшаем кадр.
+    while True:
+        quality = PAYLOAD_JPEG_QUALITY
+        while True:
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=quality, optimize=True)
+            data = buf.getvalue()
+            if len(data) <= target_bytes or quality - 10 < OCR_IMAGE_MIN_QUALITY:
+                break
+            quality -= 10
+        if len(data) <= target_bytes or max(img.size) <= 1024:
+            return data
+        img = img.resize((int(img.size[0] * 0.8), int(img.size[1] * 0.8)), Image.LANCZOS)
+
+
+def ocr_payload(item: Dict[str, Any]) -> bytes:
+    if not OCR_IMAGE_PROFILE:
+        return payload_bytes(item)
+    return encode_within_budget(ocr_frame(item), OCR_IMAGE_TARGET_BYTES)
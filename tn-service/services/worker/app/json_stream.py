@@ -0,0 +1,65 @@
+import json
+from typing import Any, Dict
+
+
+class IncrementalObjectParser:
+    """
+    Разбирает JSON-объект, приходящий кусками из стрима модели.
+    feed() возвращает верхнеуровневые поля, значения которых уже полностью получены.
+    Если ответ явно не JSON-объект, бросает ValueError — запрос можно прервать сразу.
+    """
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.segment_start = None
+        self.fields: Dict[str, Any] = {}
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        self.buf += chunk
+        new = {}
+        while self.pos < len(self.buf):
+            ch = self.buf[self.pos]
+            if not self.started:
+                if ch.isspace():
+                    self.pos += 1
+                    continue
+                if ch != "{":
+                    raise ValueError(f"ответ модели не похож на JSON: {self.buf[:80]!r}")
+                self.started = True
+                self.depth = 1
+                self.segment_start = self.pos + 1
+                self.pos += 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    new.update(self._close_segment(self.pos))
+            elif ch == "," and self.depth == 1:
+                new.update(self._close_segment(self.pos))
+                self.segment_start = self.pos + 1
+            self.pos += 1
+        self.fields.update(new)
+        return new
+
+    def _close_segment(self, end: int) -> Dict[str, Any]:
+        segment = self.buf[self.segment_start:end].strip()
+        if not segment:
+            return {}
+        return json.loads("{" + segment + "}")
@@ -1,6 +1,8 @@
-import os, time, requests
-from PIL import Image
+import os, time, uuid
+import httpx
+from .images import save_download
 from .config import DOWNLOAD_DIR
+from .platform_http import PlatformClient
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
@@ -8,70 +10,83 @@ MAX_API_URL = "https://platform-api.max.ru"
 MAX_TOKEN = os.getenv("MAX_BOT_TOKEN")
 HEADERS = {"Authorization": f"{MAX_TOKEN}"}
 
+# Один клиент на процесс для platform-api.max.ru и CDN с файлами. Токен не задаётся клиенту целиком:
+# он уходит только в запросы к API, а не на CDN (при редиректе на другой хост httpx его тоже снимает).
+CLIENT = PlatformClient("max", MAX_API_URL)
+API_HOST = httpx.URL(MAX_API_URL).host
+
+def _attachments(reply_markup):
+    if not reply_markup or "inline_keyboard" not in reply_markup:
+        return None
+    max_buttons = []
+    for row in reply_markup["inline_keyboard"]:
+        max_row = []
+        for btn in row:
+            if "callback_data" in btn:
+                max_row.append({
+                    "type": "callback",
+                    "text": str(btn["text"]),
+                    "payload": str(btn["callback_data"])
+                })
+            elif "url" in btn:
+                max_row.append({
+                    "type": "link",
+                    "text": str(btn["text"]),
+                    "url": str(btn["url"])
+                })
+        max_buttons.append(max_row)
+    return [{"type": "inline_keyboard", "payload": {"buttons": max_buttons}}]
+
+def _extract_mid(resp_json):
+    if not isinstance(resp_json, dict):
+        return None
+    message = resp_json.get("message")
+    if isinstance(message, dict) and isinstance(message.get("body"), dict):
+        return message["body"].get("mid")
+    return resp_json.get("mid") or resp_json.get("message_id")
+
 def send_message(chat_id, text, reply_markup=None, attempts=3):
     # В MAX API chat_id передается через параметры URL
     params = {"chat_id": chat_id}
     
     # А текст и вложения передаются в JSON теле
     body = {"text": text}
-    
-    if reply_markup and "inline_keyboard" in reply_markup:
-        max_buttons = []
-        for row in reply_markup["inline_keyboard"]:
-            max_row = []
-            for btn in row:
-                if "callback_data" in btn:
-                    max_row.append({
-                        "type": "callback",
-                        "text": str(btn["text"]),
-                        "payload": str(btn["callback_data"])
-                    })
-                elif "url" in btn:
-                    max_row.append({
-                        "type": "link",
-                        "text": str(btn["text"]),
-                        "url": str(btn["url"])
-                    })
-            max_buttons.append(max_row)
+    atts = _attachments(reply_markup)
+    if atts:
+        body["attachments"] = atts
 
-        body["attachments"] = [{
-            "type": "inline_keyboard",
-            "payload": {"buttons": max_buttons}
-        }]
+    try:
+        resp = CLIENT.post("/messages", params=params, json=body, headers=HEADERS, attempts=attempts)
+        resp.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        # Если MAX вернет 400, подробная причина будет прямо в логах
+        error_details = e.response.text
+        print(f"❌ Подробности ошибки MAX API: {error_details}", flush=True)
+        raise RuntimeError(f"MAX sendMessage failed: {e} - {error_details}")
+    except Exception as e:
+        raise RuntimeError(f"MAX sendMessage failed: {e}")
+    try:
+        return _extract_mid(resp.json()) or True
+    except ValueError:
+        return True
 
-    last_err = None
-    for i in range(1, attempts + 1):
-        try:
-            resp = requests.post(f"{MAX_API_URL}/messages", params=params, json=body, headers=HEADERS, timeout=20)
-            resp.raise_for_status()
-            return True
-        except requests.exceptions.HTTPError as e:
-            # Теперь, если MAX вернет 400, мы увидим подробную причину прямо в логах!
-            error_details = e.response.text
-            print(f"❌ Подробности ошибки MAX API: {error_details}", flush=True)
-            last_err = f"{e} - {error_details}"
-            time.sleep(1.5)
-        except Exception as e:
-            last_err = str(e)
-            time.sleep(1.5)
-            
-    raise RuntimeError(f"MAX sendMessage failed: {last_err}")
+def edit_message(mid, text, reply_markup=None):
+    body = {"text": text, "attachments": _attachments(reply_markup) or []}
+    try:
+        resp = CLIENT.put("/messages", params={"message_id": mid}, json=body, headers=HEADERS)
+        resp.raise_for_status()
+        return True
+    except Exception as e:
+        print(f"⚠️ MAX edit message failed: {e}", flush=True)
+        return False
 
 def download_photo(url):
-    file_name = str(int(time.time() * 1000))
+    """Скачивает фото в память и сохраняет на диск; возвращает (путь, байты) для дальнейшей обработки без перечитывания."""
+    # uuid-суффикс: несколько слотов воркера могут скачивать файлы в одну и ту же миллисекунду
+    file_name = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
     local = f"{DOWNLOAD_DIR}/{file_name}.jpg"
-    tmp_local = f"{DOWNLOAD_DIR}/{file_name}_tmp.file"
-
-    with requests.get(url, headers=HEADERS, stream=True, timeout=60) as r:
-        r.raise_for_status()
-        with open(tmp_local, "wb") as f:
-            for chunk in r.iter_content(1024 * 128):
-                if chunk: f.write(chunk)
-    try:
-        with Image.open(tmp_local) as img:
-            rgb_im = img.convert("RGB")
-            rgb_im.save(local, "JPEG", quality=95)
-        os.remove(tmp_local)
-    except Exception as e:
-        os.rename(tmp_local, local)
-    return local
+    headers = HEADERS if httpx.URL(url).host == API_HOST else None
+    r = CLIENT.get(url, endpoint="file", headers=headers, follow_redirects=True, timeout=60)
+    r.raise_for_status()
+    raw = r.content
+    return local, save_download(raw, local)
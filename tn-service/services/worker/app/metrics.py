@@ -0,0 +1,63 @@
+import json, os, socket, threading, time
+
+# Простые счётчики/тайминги процесса воркера. Периодически публикуются в Redis
+# (hash metrics:worker:<id>) и печатаются в лог, чтобы можно было подбирать размеры пулов.
+WORKER_ID = os.getenv("WORKER_ID") or socket.gethostname()
+METRICS_KEY = f"metrics:worker:{WORKER_ID}"
+METRICS_INTERVAL = float(os.getenv("WORKER_METRICS_INTERVAL", "60"))
+
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_GAUGES = {}
+_TIMINGS = {}
+
+
+def incr(name, n=1):
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+
+def gauge(name, value):
+    with _LOCK:
+        _GAUGES[name] = value
+
+
+def observe(name, seconds):
+    with _LOCK:
+        t = _TIMINGS.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        t["count"] += 1
+        t["total"] += seconds
+        t["max"] = max(t["max"], seconds)
+
+
+def snapshot():
+    with _LOCK:
+        out = dict(_COUNTERS)
+        out.update(_GAUGES)
+        for name, t in _TIMINGS.items():
+            out[f"{name}.count"] = t["count"]
+            out[f"{name}.avg"] = round(t["total"] / t["count"], 3) if t["count"] else 0.0
+            out[f"{name}.max"] = round(t["max"], 3)
+        return out
+
+
+def publish(rds):
+    snap = snapshot()
+    snap["ts"] = int(time.time())
+    try:
+        rds.hset(METRICS_KEY, mapping={k: json.dumps(v) for k, v in snap.items()})
+        rds.expire(METRICS_KEY, int(METRICS_INTERVAL * 5))
+    except Exception as e:
+        print(f"⚠️ [METRICS] Не удалось записать метрики в Redis: {e}", flush=True)
+    print(f"📊 [METRICS] {json.dumps(snap, ensure_ascii=False, sort_keys=True)}", flush=True)
+
+
+def start_reporter(rds, stop_event):
+    def _loop():
+        while not stop_event.wait(METRICS_INTERVAL):
+            publish(rds)
+        publish(rds)
+
+    t = threading.Thread(target=_loop, name="metrics-reporter", daemon=True)
+    t.start()
+    return t
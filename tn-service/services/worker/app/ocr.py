@@ -1,12 +1,26 @@
-import base64, json, os
+import base64, hashlib, json, os, time
 from typing import List, Dict, Any, Tuple
 from PIL import Image, ImageFilter, ImageStat
-from openai import OpenAI
+from . import images as image_stage
+from .images import ocr_payload
+from . import metrics, ocr_cache, dedup
+from .openai_client import OPENAI_HEDGE, create_completion, stream_completion
+from .json_stream import IncrementalObjectParser
+from .config import MIN_CONFIDENCE
 
 MODEL_VISION = os.getenv("OPENAI_OCR_MODEL", "gpt-5.2")
+# Быстрая модель первого прохода (например, gpt-5-mini); по умолчанию каскад выключен — сразу сильная модель.
+MODEL_FAST = os.getenv("OPENAI_OCR_FAST_MODEL", "")
+# Модели, которые принимают только temperature по умолчанию (рассуждающие): параметр им не передаём.
+FIXED_TEMPERATURE_MODELS = tuple(m.strip() for m in os.getenv("OPENAI_FIXED_TEMPERATURE_MODELS", "gpt-5-mini,gpt-5-nano,o1,o3,o4").split(",") if m.strip())
+MANDATORY_FIELDS = {"loading_date": "value", "sender_address": "value", "driver_name": "value", "weight_total": "kg"}
 MIN_ENTROPY = float(os.getenv("OCR_MIN_ENTROPY", "2.2"))
 MIN_EDGE_MEAN = float(os.getenv("OCR_MIN_EDGE_MEAN", "9.0"))
 MIN_WHITE_RATIO = float(os.getenv("OCR_MIN_WHITE_RATIO", "0.52"))
+# Опорный размер для метрик: сжатые фото Telegram приходят с длинной стороной до 1280 px,
+# на них пороги MIN_* и подбирались; более крупные кадры приводятся к тому же масштабу.
+METRICS_MAX_EDGE = int(os.getenv("OCR_METRICS_MAX_EDGE", "1280"))
+WHITE_LEVEL = 200
 
 USER_PROMPT = """Ты — логистический ИИ-ассистент, эксперт по распознаванию российских транспортных накладных (ТН) и товарно-транспортных накладных (ТТН).
 Внимательно изучи приложенные изображения. Твоя главная задача — точно определить "Грузоотправителя", не перепутав его с Поставщиком, Плательщиком или Грузополучателем.
@@ -34,21 +48,92 @@ USER_PROMPT = """Ты — логистический ИИ-ассистент, э
   "driver_name": { "value": "Фамилия И. О." },
   "product_type": { "value": "ДТ-Е-К5" },
   "weight_total": { "kg": 24705 },
-  "confidence": 0.99
+  "confidence": 0.99,
+  "regions": {
+    "weight_total": { "page": 1, "box": [0.52, 0.61, 0.97, 0.74] }
+  }
 }
+
+В "regions" для каждого поля укажи, где оно находится: номер изображения (page, с 1) и прямоугольник
+box = [x0, y0, x1, y1] в долях ширины/высоты изображения (0..1). Указывай область, даже если текст
+в ней не удалось прочитать. Поля, которых нет в документе, в "regions" не включай.
 """
 
+# Потоковый ответ первого прохода: поля показываются водителю по мере получения.
+# При OPENAI_HEDGE=on запросы идут без стрима: хеджирование работает только для обычного вызова.
+OCR_STREAM = os.getenv("OCR_STREAM", "on").lower() not in ("0", "off", "false", "no")
+
+# Повторный запрос по одной области страницы в высоком разрешении — для пустых или неправдоподобных полей.
+OCR_ROI_REFINE = os.getenv("OCR_ROI_REFINE", "on").lower() not in ("0", "off", "false", "no")
+OCR_ROI_MAX_FIELDS = int(os.getenv("OCR_ROI_MAX_FIELDS", "2"))
+WEIGHT_MIN_KG = int(os.getenv("OCR_WEIGHT_MIN_KG", "50"))
+WEIGHT_MAX_KG = int(os.getenv("OCR_WEIGHT_MAX_KG", "60000"))
+FIELD_LABELS = {
+    "loading_date": "дата составления документа (DD.MM.YYYY)",
+    "sender_address": "грузоотправитель: название компании/ИП и адрес",
+    "driver_name": "ФИО водителя",
+    "weight_total": "масса груза нетто в килограммах (целое число)",
+    "product_type": "наименование груза",
+}
+
+
+def cache_version() -> str:
+    # Любая смена модели, промпта или профиля изображения делает старые записи кэша неактуальными.
+    profile = (image_stage.OCR_IMAGE_PROFILE, image_stage.OCR_IMAGE_MAX_EDGE, image_stage.OCR_IMAGE_GRAYSCALE,
+               image_stage.OCR_IMAGE_AUTOCROP, image_stage.OCR_IMAGE_DESKEW, image_stage.OCR_IMAGE_TARGET_BYTES,
+               image_stage.OCR_IMAGE_AUTOCONTRAST)
+    prompt_hash = hashlib.sha256(USER_PROMPT.encode("utf-8")).hexdigest()[:16]
+    return f"{MODEL_FAST}>{MODEL_VISION}|{MIN_CONFIDENCE}|{prompt_hash}|{profile}|roi={OCR_ROI_REFINE}"
+
+
+def _remap_pages(cached: Dict[str, Any], hashes: List[str]) -> Dict[str, Any]:
+    # regions[*].page — номер страницы в порядке той отправки, что попала в кэш; переводим в текущий.
+    old = cached.get("ocr_page_hashes")
+    regions = cached.get("regions")
+    if not isinstance(regions, dict):
+        return cached
+    if not old:
+        cached.pop("regions", None)
+        return cached
+    position = {h: i + 1 for i, h in enumerate(hashes)}
+    for region in regions.values():
+        try:
+            page = int(region.get("page"))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if 1 <= page <= len(old) and old[page - 1] in position:
+            region["page"] = position[old[page - 1]]
+    return cached
+
+
+def signal_metrics(gray: Image.Image) -> Tuple[float, float, float, int, int]:
+    width, height = gray.size
+    # Энтропия и доля белого — из одной 256-корзинной гистограммы, без списка пикселей в Python.
+    hist = gray.histogram()
+    total = max(sum(hist), 1)
+    entropy = gray.entropy()
+    white_ratio = sum(hist[WHITE_LEVEL:]) / total
+    edge_mean = ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).mean[0]
+    return entropy, edge_mean, white_ratio, width, height
+
 
-def _signal_metrics(path: str) -> Tuple[float, float, float, int, int]:
-    with Image.open(path) as img:
-        gray = img.convert("L")
-        width, height = gray.size
-        entropy = gray.entropy()
-        edge_img = gray.filter(ImageFilter.FIND_EDGES)
-        edge_mean = ImageStat.Stat(edge_img).mean[0]
-        pixels = list(gray.getdata())
-        white_ratio = sum(1 for p in pixels if p >= 200) / max(len(pixels), 1)
-        return entropy, edge_mean, white_ratio, width, height
+def _metrics_gray(item: Dict[str, Any]) -> Image.Image:
+    # Энтропия и края зависят от масштаба кадра, поэтому метрики считаются в одном опорном
+    # размере, а не в том, в каком фото пришло или декодировано для OCR.
+    if item.get("raw") is None:
+        return item["gray"]
+    return image_stage.analysis_gray(item["raw"], METRICS_MAX_EDGE)
+
+
+def item_metrics(item: Dict[str, Any]) -> Tuple[float, float, float, int, int]:
+    # Метрики обычно уже посчитаны в потоке скачивания (см. worker.download_all).
+    if item.get("metrics") is None:
+        entropy, edge_mean, white_ratio, width, height = signal_metrics(_metrics_gray(item))
+        # В логах отбора — размер фото, а не опорного кадра метрик.
+        if item.get("source_size") and item["source_size"][0]:
+            width, height = item["source_size"]
+        item["metrics"] = (entropy, edge_mean, white_ratio, width, height)
+    return item["metrics"]
 
 
 def _is_likely_document(entropy: float, edge_mean: float, white_ratio: float) -> bool:
@@ -59,83 +144,265 @@ def _is_likely_document(entropy: float, edge_mean: float, white_ratio: float) ->
     return strict_rule or relaxed_rule
 
 
-def select_images_for_ocr(image_paths: List[str]) -> List[str]:
-    total_input = len(image_paths)
-    valid_paths = [p for p in image_paths if p and os.path.exists(p)]
-    invalid_count = total_input - len(valid_paths)
+def select_images_for_ocr(images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    total_input = len(images)
+    valid = [it for it in images if it and it.get("gray") is not None]
+    invalid_count = total_input - len(valid)
 
     print(
         "🧾 [OCR] Статистика входа: "
-        f"всего={total_input}, валидных={len(valid_paths)}, невалидных={invalid_count}, "
+        f"всего={total_input}, валидных={len(valid)}, невалидных={invalid_count}, "
         f"пороги entropy>={MIN_ENTROPY}, edges>={MIN_EDGE_MEAN}, white_ratio>={MIN_WHITE_RATIO}"
     )
 
-    if not valid_paths:
+    if not valid:
         return []
 
     likely_doc = []
     rejected = []
 
-    for p in valid_paths:
+    for it in valid:
         try:
-            entropy, edge_mean, white_ratio, w, h = _signal_metrics(p)
+            entropy, edge_mean, white_ratio, w, h = item_metrics(it)
             if _is_likely_document(entropy, edge_mean, white_ratio):
-                likely_doc.append((p, entropy, edge_mean, white_ratio, w, h))
+                likely_doc.append((it, entropy, edge_mean, white_ratio, w, h))
             else:
-                rejected.append((p, entropy, edge_mean, white_ratio, w, h))
+                rejected.append((it, entropy, edge_mean, white_ratio, w, h))
         except Exception:
-            rejected.append((p, 0.0, 0.0, 0.0, 0, 0))
+            rejected.append((it, 0.0, 0.0, 0.0, 0, 0))
 
     if likely_doc:
-        print(f"🧾 [OCR] Отбор: отправим={len(likely_doc)}, пропустим={len(rejected)}, валидных={len(valid_paths)}")
+        print(f"🧾 [OCR] Отбор: отправим={len(likely_doc)}, пропустим={len(rejected)}, валидных={len(valid)}")
 
         print("📤 [OCR] Выбраны для OpenAI:")
-        for path, entropy, edge_mean, white_ratio, w, h in likely_doc:
-            print(f"  + {path} | {w}x{h} | entropy={entropy:.2f}, edges={edge_mean:.2f}, white={white_ratio:.2f}")
+        for it, entropy, edge_mean, white_ratio, w, h in likely_doc:
+            print(f"  + {it['path']} | {w}x{h} | entropy={entropy:.2f}, edges={edge_mean:.2f}, white={white_ratio:.2f}")
 
         if rejected:
             print("🧹 [OCR] Пропущены как недокументные:")
-            for path, entropy, edge_mean, white_ratio, w, h in rejected:
-                print(f"  - {path} | {w}x{h} | entropy={entropy:.2f}, edges={edge_mean:.2f}, white={white_ratio:.2f}")
+            for it, entropy, edge_mean, white_ratio, w, h in rejected:
+                print(f"  - {it['path']} | {w}x{h} | entropy={entropy:.2f}, edges={edge_mean:.2f}, white={white_ratio:.2f}")
 
-        return [p for p, _, _, _, _, _ in likely_doc]
+        return [it for it, _, _, _, _, _ in likely_doc]
 
     print(
         "⚠️ [OCR] Документные фото не определены по эвристике; fallback: отправляем все валидные "
-        f"({len(valid_paths)}/{total_input})."
+        f"({len(valid)}/{total_input})."
     )
-    return valid_paths
+    return valid
 
 
-def extract_batch(image_paths: List[str]) -> Dict[str, Any]:
-    selected_paths = select_images_for_ocr(image_paths)
-    if not selected_paths:
-        raise RuntimeError("Не найдено ни одного валидного изображения для OCR")
+def _sharpness(item: Dict[str, Any]) -> float:
+    try:
+        return item_metrics(item)[1]
+    except Exception:
+        return 0.0
 
-    skipped = len(image_paths) - len(selected_paths)
-    print(f"🧠 [OCR] К отправке в OpenAI: {len(selected_paths)} шт.; пропущено: {skipped} шт.")
-    print(f"🧠 [OCR] Инициализация модели {MODEL_VISION}...")
 
-    client = OpenAI()
-    content = [{"type": "text", "text": USER_PROMPT}]
+def _image_parts(selected: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    parts = []
+    payload_total = 0
+    for i, it in enumerate(selected, 1):
+        started = time.monotonic()
+        data = ocr_payload(it)
+        payload_total += len(data)
+        metrics.observe("ocr.page_encode_seconds", time.monotonic() - started)
+        metrics.observe("ocr.page_bytes", len(data))
+        print(f"🧠 [OCR] Кодирование изображения {i}/{len(selected)}: {it['path']} → {len(data) // 1024} KB")
+        b64 = base64.b64encode(data).decode("ascii")
+        parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}})
+    metrics.observe("ocr.request_bytes", payload_total)
+    print(f"🧠 [OCR] Изображения для запроса: {payload_total // 1024} KB")
+    return parts
 
-    for i, p in enumerate(selected_paths, 1):
-        print(f"🧠 [OCR] Кодирование изображения {i}/{len(selected_paths)}: {p}")
-        with open(p, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode("ascii")
-        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}})
 
-    print("🧠 [OCR] Отправка запроса к OpenAI API...")
-    resp = client.chat.completions.create(
-        model=MODEL_VISION,
-        messages=[{"role": "user", "content": content}],
+def _ask(model: str, prompt: str, image_parts: List[Dict[str, Any]], label: str, on_fields=None) -> Dict[str, Any]:
+    print(f"🧠 [OCR] Отправка запроса к OpenAI API ({model})...")
+    request = dict(
+        model=model,
+        messages=[{"role": "user", "content": [{"type": "text", "text": prompt}] + image_parts}],
         response_format={"type": "json_object"},
-        temperature=0.0,
     )
+    if not model.startswith(FIXED_TEMPERATURE_MODELS):
+        request["temperature"] = 0.0
+    if on_fields is None or not OCR_STREAM or OPENAI_HEDGE:
+        resp = create_completion(label=label, **request)
+        print("🧠 [OCR] Ответ получен, разбор JSON...")
+        return json.loads(resp.choices[0].message.content)
+
+    parser = IncrementalObjectParser()
+
+    def _on_text(chunk):
+        # Ошибка разбора прерывает стрим сразу, не дожидаясь конца заведомо испорченного ответа.
+        new = parser.feed(chunk)
+        if new:
+            try:
+                on_fields(dict(parser.fields))
+            except Exception as e:
+                print(f"⚠️ [OCR] Ошибка промежуточного обновления: {e}")
+
+    text = stream_completion(_on_text, label=label, **request)
+    print("🧠 [OCR] Стрим завершён, разбор JSON...")
+    return json.loads(text)
+
+
+def missing_mandatory(result: Dict[str, Any]) -> List[str]:
+    missing = []
+    for field, key in MANDATORY_FIELDS.items():
+        val = (result.get(field) or {}).get(key) if isinstance(result.get(field), dict) else None
+        if val in (None, "", "—"):
+            missing.append(field)
+    return missing
+
+
+def _escalation_prompt(fast_result: Dict[str, Any], unresolved: List[str]) -> str:
+    known = {k: v for k, v in fast_result.items() if k in MANDATORY_FIELDS and k not in unresolved}
+    return (
+        USER_PROMPT
+        + "\n\nЧасть полей уже извлечена, их НЕ нужно возвращать:\n"
+        + json.dumps(known, ensure_ascii=False)
+        + "\n\nВерни JSON только с полями: " + ", ".join(unresolved + ["carrier_name", "unloading_address", "confidence"])
+        + ". Остальные поля схемы не включай."
+    )
+
+
+def implausible_fields(result: Dict[str, Any]) -> List[str]:
+    out = []
+    kg = (result.get("weight_total") or {}).get("kg") if isinstance(result.get("weight_total"), dict) else None
+    if kg not in (None, "", "—"):
+        try:
+            if not (WEIGHT_MIN_KG <= float(str(kg).replace(" ", "").replace(",", ".")) <= WEIGHT_MAX_KG):
+                out.append("weight_total")
+        except ValueError:
+            out.append("weight_total")
+    return out
+
+
+def refine_field(selected: List[Dict[str, Any]], field: str, region: Dict[str, Any]) -> Dict[str, Any]:
+    """Перечитывает одно поле по высокодетальной вырезке области, которую указала модель."""
+    page = int(region.get("page") or 1)
+    if not (1 <= page <= len(selected)):
+        raise ValueError(f"нет страницы {page}")
+    started = time.monotonic()
+    crop = image_stage.region_crop(selected[page - 1], region["box"])
+    key = MANDATORY_FIELDS.get(field, "value")
+    prompt = (
+        "На изображении — фрагмент российской транспортной накладной. "
+        f"Извлеки только поле {field}: {FIELD_LABELS.get(field, field)}.\n"
+        f'Верни JSON: {{"{field}": {{"{key}": ...}}, "confidence": 0.0-1.0}}. '
+        f'Если поле не читается, верни {{"{field}": {{"{key}": null}}, "confidence": 0}}.'
+    )
+    b64 = base64.b64encode(crop).decode("ascii")
+    parts = [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}", "detail": "high"}}]
+    out = _ask(MODEL_VISION, prompt, parts, "ocr_roi")
+    metrics.observe("ocr.roi.seconds", time.monotonic() - started)
+    metrics.observe("ocr.roi.bytes", len(crop))
+    return out
+
+
+def _refine_weak_fields(selected: List[Dict[str, Any]], result: Dict[str, Any]) -> Dict[str, Any]:
+    regions = result.get("regions") if isinstance(result.get("regions"), dict) else {}
+    weak = missing_mandatory(result) + implausible_fields(result)
+    candidates = [f for f in dict.fromkeys(weak) if isinstance(regions.get(f), dict) and regions[f].get("box")]
+    for field in candidates[:OCR_ROI_MAX_FIELDS]:
+        try:
+            print(f"🔎 [OCR] Уточняем поле {field} по области {regions[field]}")
+            out = refine_field(selected, field, regions[field])
+        except Exception as e:
+            metrics.incr("ocr.roi.failed")
+            print(f"⚠️ [OCR] Не удалось уточнить {field}: {e}")
+            continue
+        value = out.get(field) if isinstance(out.get(field), dict) else {}
+        if value.get(MANDATORY_FIELDS.get(field, "value")) not in (None, "", "—"):
+            result[field] = value
+            metrics.incr("ocr.roi.recovered")
+            print(f"✅ [OCR] Поле {field} уточнено: {value}")
+        else:
+            metrics.incr("ocr.roi.unresolved")
+    return result
+
+
+def _extract_tiered(image_parts: List[Dict[str, Any]], on_fields=None) -> Dict[str, Any]:
+    # Быстрая модель отвечает первой; сильная подключается только при низкой уверенности
+    # или пустых обязательных полях и получает только нерешённые поля.
+    if not MODEL_FAST or MODEL_FAST == MODEL_VISION:
+        started = time.monotonic()
+        result = _ask(MODEL_VISION, USER_PROMPT, image_parts, "ocr", on_fields)
+        metrics.observe("ocr.tier.strong.seconds", time.monotonic() - started)
+        result["ocr_tier"] = "strong"
+        return result
+
+    started = time.monotonic()
+    try:
+        fast = _ask(MODEL_FAST, USER_PROMPT, image_parts, "ocr_fast", on_fields)
+    except Exception as e:
+        # Отказ быстрой модели (400 на параметры, битый JSON, таймаут) не должен ронять OCR — идём сразу в сильную.
+        metrics.incr("ocr.tier.fast.failed")
+        print(f"⚠️ [OCR] Быстрая модель {MODEL_FAST} не ответила ({e}), эскалация на {MODEL_VISION}")
+        started = time.monotonic()
+        result = _ask(MODEL_VISION, USER_PROMPT, image_parts, "ocr_strong", on_fields)
+        metrics.observe("ocr.tier.strong.seconds", time.monotonic() - started)
+        result["ocr_tier"] = "strong"
+        return result
+    metrics.observe("ocr.tier.fast.seconds", time.monotonic() - started)
+    unresolved = missing_mandatory(fast)
+    confidence = float(fast.get("confidence") or 0)
+
+    if not unresolved and confidence >= MIN_CONFIDENCE:
+        metrics.incr("ocr.tier.fast.accepted")
+        print(f"⚡ [OCR] Принят ответ быстрой модели {MODEL_FAST} (confidence={confidence:.2f})")
+        fast["ocr_tier"] = "fast"
+        return fast
+
+    metrics.incr("ocr.tier.strong.escalated")
+    started = time.monotonic()
+    if unresolved:
+        print(f"⬆️ [OCR] Эскалация на {MODEL_VISION}: не найдены {', '.join(unresolved)}")
+        strong = _ask(MODEL_VISION, _escalation_prompt(fast, unresolved), image_parts, "ocr_strong")
+        result = dict(fast)
+        for field in unresolved + ["carrier_name", "unloading_address"]:
+            if isinstance(strong.get(field), dict):
+                result[field] = strong[field]
+        result["confidence"] = strong.get("confidence", confidence)
+    else:
+        print(f"⬆️ [OCR] Эскалация на {MODEL_VISION}: низкая уверенность ({confidence:.2f})")
+        result = _ask(MODEL_VISION, USER_PROMPT, image_parts, "ocr_strong")
+    metrics.observe("ocr.tier.strong.seconds", time.monotonic() - started)
+    result["ocr_tier"] = "strong"
+    return result
+
+
+def extract_batch(images: List[Dict[str, Any]], chat_id=None, on_fields=None) -> Dict[str, Any]:
+    """on_fields(fields) — необязательный колбэк с уже полученными полями при потоковом ответе."""
+    selected = select_images_for_ocr(images)
+    if not selected:
+        raise RuntimeError("Не найдено ни одного валидного изображения для OCR")
+
+    # Из почти одинаковых кадров одной страницы в OpenAI уходит только самый резкий.
+    selected = dedup.drop_near_duplicates(selected, _sharpness)
+    dedup.count_recent_repeats(chat_id, selected)
+
+    skipped = len(images) - len(selected)
+    cache_key = ocr_cache.cache_key(selected, cache_version())
+    hashes = [ocr_cache.page_hash(it) for it in selected]
+    cached = ocr_cache.get(cache_key)
+    if cached is not None:
+        print(f"♻️ [OCR] Результат взят из кэша ({cache_key[:12]}), запрос к OpenAI не нужен.")
+        # Страницы — файлы этой отправки, а не той, что попала в кэш.
+        cached = _remap_pages(cached, hashes)
+        cached["ocr_pages"] = [it["path"] for it in selected]
+        cached["ocr_page_hashes"] = hashes
+        return cached
 
-    print("🧠 [OCR] Ответ получен, разбор JSON...")
-    result = json.loads(resp.choices[0].message.content)
+    print(f"🧠 [OCR] К отправке в OpenAI: {len(selected)} шт.; пропущено: {skipped} шт.")
+    result = _extract_tiered(_image_parts(selected), on_fields)
+    # Порядок страниц, к которому относятся regions[*].page, — для повторных уточнений по областям.
+    result["ocr_pages"] = [it["path"] for it in selected]
+    result["ocr_page_hashes"] = hashes
+    if OCR_ROI_REFINE:
+        result = _refine_weak_fields(selected, result)
     result.setdefault("carrier_name", {"value": None})
     result.setdefault("unloading_address", {"value": None})
     print(f"🧠 [OCR] Финальный вердикт ИИ:\n{json.dumps(result, indent=2, ensure_ascii=False)}")
+    ocr_cache.put(cache_key, result)
     return result
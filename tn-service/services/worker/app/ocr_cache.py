@@ -0,0 +1,86 @@
+import hashlib, json, os, time
+import redis
+from .config import REDIS_URL
+from . import metrics
+
+# Кэш результатов OCR по содержимому отобранных фото + версии промпта/модели.
+# Повторная отправка того же альбома ("📸 Переснять", пересылка) не вызывает модель второй раз.
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE", "on").lower() not in ("0", "off", "false", "no")
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", str(7 * 24 * 3600)))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "20000"))
+
+KEY_PREFIX = "ocr:cache:"
+INDEX_KEY = "ocr:cache:index"
+STATS_KEY = "ocr:cache:stats"
+
+_rds = None
+
+
+def _client():
+    global _rds
+    if _rds is None:
+        _rds = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _rds
+
+
+def page_hash(item):
+    return hashlib.sha256(item["raw"]).hexdigest()
+
+
+def cache_key(items, version):
+    # Порядок фото в альбоме на поля не влияет — сортируем хэши страниц. Номера страниц
+    # в regions при попадании пересчитываются под новый порядок (см. ocr.extract_batch).
+    pages = sorted(page_hash(it) for it in items)
+    h = hashlib.sha256(version.encode("utf-8"))
+    for p in pages:
+        h.update(p.encode("ascii"))
+    return h.hexdigest()
+
+
+def _count(name, n=1):
+    metrics.incr(f"ocr.cache.{name}", n)
+    try:
+        _client().hincrby(STATS_KEY, name, n)
+    except Exception:
+        pass
+
+
+def get(key):
+    if not OCR_CACHE_ENABLED:
+        return None
+    try:
+        raw = _client().get(KEY_PREFIX + key)
+    except Exception as e:
+        print(f"⚠️ [OCR CACHE] Ошибка чтения: {e}", flush=True)
+        return None
+    if raw is None:
+        _count("miss")
+        return None
+    _count("hit")
+    return json.loads(raw)
+
+
+def put(key, result):
+    if not OCR_CACHE_ENABLED:
+        return
+    try:
+        rds = _client()
+        pipe = rds.pipeline()
+        pipe.set(KEY_PREFIX + key, json.dumps(result, ensure_ascii=False), ex=OCR_CACHE_TTL)
+        pipe.zadd(INDEX_KEY, {key: time.time()})
+        pipe.zcard(INDEX_KEY)
+        size = pipe.execute()[-1]
+        # Вытесняем самые старые записи сверх лимита; протухшие по TTL чистим из индекса там же.
+        overflow = size - OCR_CACHE_MAX_ENTRIES
+        expired = rds.zrangebyscore(INDEX_KEY, 0, time.time() - OCR_CACHE_TTL)
+        victims = set(expired)
+        if overflow > 0:
+            victims.update(rds.zrange(INDEX_KEY, 0, overflow - 1))
+        if victims:
+            pipe = rds.pipeline()
+            pipe.delete(*[KEY_PREFIX + v for v in victims])
+            pipe.zrem(INDEX_KEY, *victims)
+            pipe.execute()
+            _count("evicted", len(victims))
+    except Exception as e:
+        print(f"⚠️ [OCR CACHE] Ошибка записи: {e}", flush=True)
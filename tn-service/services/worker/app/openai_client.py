@@ -0,0 +1,180 @@
+import os, random, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+import openai
+from openai import OpenAI
+from . import metrics
+
+# Один клиент OpenAI на процесс: пул keep-alive соединений, явные таймауты,
+# собственные ретраи с джиттером на 429/5xx и опциональный "хеджирующий" второй запрос.
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "90"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "240"))
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
+OPENAI_RETRY_BASE = float(os.getenv("OPENAI_RETRY_BASE", "1.5"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "16"))
+
+# Хеджирование: если запрос идёт дольше перцентиля недавних задержек — параллельно шлём второй.
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "off").lower() in ("1", "on", "true", "yes")
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "95"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+
+_client = None
+_client_lock = threading.Lock()
+_latencies = deque(maxlen=200)
+_latencies_lock = threading.Lock()
+_hedge_pool = ThreadPoolExecutor(max_workers=OPENAI_POOL_SIZE, thread_name_prefix="openai-hedge")
+
+
+def get_client() -> OpenAI:
+    global _client
+    with _client_lock:
+        if _client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=OPENAI_POOL_SIZE, max_keepalive_connections=OPENAI_POOL_SIZE, keepalive_expiry=120),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            )
+            _client = OpenAI(http_client=http_client, max_retries=0, timeout=OPENAI_TIMEOUT)
+        return _client
+
+
+def _retryable(exc) -> bool:
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def _retry_after(exc):
+    response = getattr(exc, "response", None)
+    try:
+        return float(response.headers.get("retry-after")) if response is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _record_latency(seconds):
+    with _latencies_lock:
+        _latencies.append(seconds)
+
+
+def hedge_threshold():
+    with _latencies_lock:
+        samples = sorted(_latencies)
+    if len(samples) < OPENAI_HEDGE_MIN_SAMPLES:
+        return None
+    idx = min(len(samples) - 1, int(len(samples) * OPENAI_HEDGE_PERCENTILE / 100.0))
+    return samples[idx]
+
+
+def _timed_create(label, **kwargs):
+    started = time.monotonic()
+    resp = get_client().chat.completions.create(**kwargs)
+    elapsed = time.monotonic() - started
+    _record_latency(elapsed)
+    metrics.observe(f"openai.{label}.seconds", elapsed)
+    return resp
+
+
+def _hedged_create(label, **kwargs):
+    threshold = hedge_threshold()
+    first = _hedge_pool.submit(_timed_create, label, **kwargs)
+    if threshold is None:
+        return first.result()
+    done, _ = wait([first], timeout=threshold)
+    if done:
+        return first.result()
+    print(f"🪁 [OPENAI] Запрос дольше p{OPENAI_HEDGE_PERCENTILE:.0f}={threshold:.1f}s, отправляем дублирующий", flush=True)
+    metrics.incr(f"openai.{label}.hedged")
+    second = _hedge_pool.submit(_timed_create, label, **kwargs)
+    pending = {first, second}
+    last_exc = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            if fut.exception() is None:
+                if fut is second:
+                    metrics.incr(f"openai.{label}.hedge_won")
+                return fut.result()
+            last_exc = fut.exception()
+    raise last_exc
+
+
+def create_completion(label="ocr", hedge=None, **kwargs):
+    """chat.completions.create с таймаутом, ретраями на 429/5xx/сетевые ошибки и общим дедлайном."""
+    hedge = OPENAI_HEDGE if hedge is None else hedge
+    deadline = time.monotonic() + OPENAI_DEADLINE
+    attempt = 0
+    while True:
+        attempt += 1
+        call_kwargs = dict(kwargs, timeout=max(5.0, min(OPENAI_TIMEOUT, deadline - time.monotonic())))
+        try:
+            if hedge:
+                return _hedged_create(label, **call_kwargs)
+            return _timed_create(label, **call_kwargs)
+        except Exception as exc:
+            if not _retryable(exc) or attempt >= OPENAI_MAX_ATTEMPTS:
+                metrics.incr(f"openai.{label}.failed")
+                raise
+            delay = _retry_after(exc) or OPENAI_RETRY_BASE * (2 ** (attempt - 1))
+            delay *= random.uniform(0.7, 1.3)
+            if time.monotonic() + delay >= deadline:
+                metrics.incr(f"openai.{label}.deadline_exceeded")
+                raise
+            metrics.incr(f"openai.{label}.retries")
+            print(f"🔁 [OPENAI] {type(exc).__name__}: {exc}; попытка {attempt + 1}/{OPENAI_MAX_ATTEMPTS} через {delay:.1f}s", flush=True)
+            time.sleep(delay)
+
+
+def stream_completion(on_text, label="ocr", **kwargs):
+    """
+    Потоковый chat.completions.create: on_text(chunk) вызывается для каждого куска ответа
+    и может бросить исключение, чтобы прервать заведомо неудачный запрос.
+    Ретраи — только пока не пришёл первый кусок; общий дедлайн OPENAI_DEADLINE проверяется
+    на каждом куске, так что медленно "капающий" ответ не растягивается за его пределы.
+    Хеджирования у потокового запроса нет — при OPENAI_HEDGE=on вызывающий код использует create_completion.
+    Возвращает полный текст ответа.
+    """
+    deadline = time.monotonic() + OPENAI_DEADLINE
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        received = False
+        parts = []
+        try:
+            stream = get_client().chat.completions.create(
+                stream=True, timeout=max(5.0, min(OPENAI_TIMEOUT, deadline - time.monotonic())), **kwargs
+            )
+            try:
+                for chunk in stream:
+                    if time.monotonic() > deadline:
+                        metrics.incr(f"openai.{label}.deadline_exceeded")
+                        raise TimeoutError(f"стрим OpenAI не уложился в OPENAI_DEADLINE={OPENAI_DEADLINE:.0f}s")
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content or ""
+                    if not delta:
+                        continue
+                    if not received:
+                        received = True
+                        metrics.observe(f"openai.{label}.first_token_seconds", time.monotonic() - started)
+                    parts.append(delta)
+                    on_text(delta)
+            finally:
+                stream.close()
+            elapsed = time.monotonic() - started
+            _record_latency(elapsed)
+            metrics.observe(f"openai.{label}.seconds", elapsed)
+            return "".join(parts)
+        except Exception as exc:
+            if received or not _retryable(exc) or attempt >= OPENAI_MAX_ATTEMPTS:
+                metrics.incr(f"openai.{label}.failed")
+                raise
+            delay = (_retry_after(exc) or OPENAI_RETRY_BASE * (2 ** (attempt - 1))) * random.uniform(0.7, 1.3)
+            if time.monotonic() + delay >= deadline:
+                metrics.incr(f"openai.{label}.deadline_exceeded")
+                raise
+            metrics.incr(f"openai.{label}.retries")
+            print(f"🔁 [OPENAI] {type(exc).__name__}: {exc}; попытка {attempt + 1}/{OPENAI_MAX_ATTEMPTS} через {delay:.1f}s", flush=True)
+            time.sleep(delay)
@@ -0,0 +1,67 @@
+import time
+import redis
+from .config import REDIS_URL
+from . import metrics
+
+# Token bucket в Redis: все процессы воркера делят одну квоту внешнего API.
+# Состояние (токены, время) обновляется Lua-скриптом атомарно; часы берутся у Redis.
+_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+  tokens = tokens - cost
+else
+  wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+_rds = None
+
+
+def _client():
+    global _rds
+    if _rds is None:
+        _rds = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _rds
+
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.key = f"ratelimit:{name}"
+        self.rate = rate
+        self.burst = burst
+        self._script = None
+
+    def acquire(self, cost: float = 1, timeout: float = 120) -> float:
+        """Ждёт, пока в общем ведре наберётся cost токенов; возвращает время ожидания. Без Redis — не ограничивает."""
+        deadline = time.monotonic() + timeout
+        waited = 0.0
+        while True:
+            try:
+                if self._script is None:
+                    self._script = _client().register_script(_SCRIPT)
+                wait = float(self._script(keys=[self.key], args=[self.rate, self.burst, cost]))
+            except redis.RedisError as e:
+                print(f"⚠️ [RATELIMIT] {self.name}: Redis недоступен ({e}), запрос без ограничения", flush=True)
+                return waited
+            if wait <= 0:
+                if waited:
+                    metrics.observe(f"ratelimit.{self.name}.wait_seconds", waited)
+                return waited
+            if time.monotonic() + wait > deadline:
+                raise TimeoutError(f"rate limit {self.name}: нет квоты {timeout:.0f}s")
+            # Токен не списан: после сна пробуем снова вместе с остальными процессами.
+            time.sleep(wait)
+            waited += wait
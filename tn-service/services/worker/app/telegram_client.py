@@ -1,43 +1,48 @@
-import os, time, requests
-from PIL import Image
+import os
+from .images import save_download
 from .config import API_BASE, FILE_BASE, DOWNLOAD_DIR
+from .platform_http import PlatformClient
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+# Один клиент на процесс: keep-alive/HTTP2 к api.telegram.org, ретраи с учётом retry_after.
+CLIENT = PlatformClient("telegram", API_BASE)
+
 def send_message(chat_id, text, reply_markup=None, attempts=3):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup is not None: payload["reply_markup"] = reply_markup
-    last_err = None
-    for i in range(1, attempts + 1):
-        try:
-            resp = requests.post(f"{API_BASE}/sendMessage", json=payload, timeout=20)
-            resp.raise_for_status()
+    try:
+        resp = CLIENT.post("/sendMessage", json=payload, attempts=attempts)
+        resp.raise_for_status()
+        return (resp.json().get("result") or {}).get("message_id") or True
+    except Exception as e:
+        raise RuntimeError(f"TG sendMessage failed: {e}")
+
+def edit_message(chat_id, message_id, text, reply_markup=None):
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if reply_markup is not None: payload["reply_markup"] = reply_markup
+    try:
+        resp = CLIENT.post("/editMessageText", json=payload)
+        # "message is not modified" — не ошибка для промежуточных обновлений
+        if resp.status_code == 400 and "not modified" in resp.text:
             return True
-        except Exception as e:
-            last_err = e
-            time.sleep(1.5)
-    raise RuntimeError(f"TG sendMessage failed: {last_err}")
+        resp.raise_for_status()
+        return True
+    except Exception as e:
+        print(f"⚠️ TG editMessageText failed: {e}", flush=True)
+        return False
 
 def get_file_path(file_id):
-    resp = requests.get(f"{API_BASE}/getFile", params={"file_id": file_id}, timeout=20)
+    resp = CLIENT.get("/getFile", params={"file_id": file_id})
     resp.raise_for_status()
     return resp.json()["result"]["file_path"]
 
 def download_photo(file_id):
+    """Скачивает фото в память и сохраняет на диск; возвращает (путь, байты) для дальнейшей обработки без перечитывания."""
     path = get_file_path(file_id)
     url = f"{FILE_BASE}/{path}"
     local = f"{DOWNLOAD_DIR}/{file_id}.jpg"
-    tmp_local = f"{DOWNLOAD_DIR}/{file_id}_tmp.file"
-    with requests.get(url, stream=True, timeout=60) as r:
-        r.raise_for_status()
-        with open(tmp_local, "wb") as f:
-            for chunk in r.iter_content(1024 * 128):
-                if chunk: f.write(chunk)
-    try:
-        with Image.open(tmp_local) as img:
-            rgb_im = img.convert("RGB")
-            rgb_im.save(local, "JPEG", quality=95)
-        os.remove(tmp_local)
-    except Exception as e:
-        os.rename(tmp_local, local)
-    return local
+    r = CLIENT.get(url, endpoint="file", follow_redirects=True, timeout=60)
+    r.raise_for_status()
+    raw = r.content
+    return local, save_download(raw, local)
@@ -0,0 +1,85 @@
+import math, os, uuid
+from typing import Any, Dict, List, Optional
+from PIL import Image
+from .config import DOWNLOAD_DIR
+from . import images as image_stage
+
+# Режим выгрузки накладной в Битрикс:
+#   photos — каждое фото отдельным файлом (как раньше);
+#   pdf    — отобранные страницы одним многостраничным PDF;
+#   sheet  — отобранные страницы одной сжатой картинкой-сеткой.
+# Один файл — одна загрузка на диск и одна публикация в чат вместо N.
+BITRIX_EXPORT_MODE = os.getenv("BITRIX_EXPORT_MODE", "photos").lower()
+PACK_JPEG_QUALITY = int(os.getenv("BITRIX_PACK_JPEG_QUALITY", "80"))
+PACK_PDF_DPI = int(os.getenv("BITRIX_PACK_PDF_DPI", "150"))
+SHEET_CELL_EDGE = int(os.getenv("BITRIX_SHEET_CELL_EDGE", "1200"))
+SHEET_GAP = 16
+
+_EXT = {"pdf": "pdf", "sheet": "jpg"}
+
+
+def enabled() -> bool:
+    return BITRIX_EXPORT_MODE in _EXT
+
+
+def packed_path(doc_id) -> str:
+    return os.path.join(DOWNLOAD_DIR, f"waybill_{doc_id}.{_EXT[BITRIX_EXPORT_MODE]}")
+
+
+def _pdf(frames: List[Image.Image], out_path: str):
+    first, rest = frames[0], frames[1:]
+    first.save(out_path, "PDF", save_all=True, append_images=rest, resolution=PACK_PDF_DPI, quality=PACK_JPEG_QUALITY)
+
+
+def _contact_sheet(frames: List[Image.Image], out_path: str):
+    cols = math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / cols)
+    cells = []
+    for frame in frames:
+        cell = frame.copy()
+        cell.thumbnail((SHEET_CELL_EDGE, SHEET_CELL_EDGE), Image.LANCZOS)
+        cells.append(cell)
+    cell_w = max(c.size[0] for c in cells)
+    cell_h = max(c.size[1] for c in cells)
+    sheet = Image.new("RGB", (cols * cell_w + (cols + 1) * SHEET_GAP, rows * cell_h + (rows + 1) * SHEET_GAP), "white")
+    for i, cell in enumerate(cells):
+        r, c = divmod(i, cols)
+        sheet.paste(cell, (SHEET_GAP + c * (cell_w + SHEET_GAP), SHEET_GAP + r * (cell_h + SHEET_GAP)))
+    sheet.save(out_path, "JPEG", quality=PACK_JPEG_QUALITY, optimize=True)
+
+
+def pack(items: List[Dict[str, Any]], out_path: str) -> Optional[str]:
+    """Собирает уже декодированные кадры (item["image"]) в один файл выбранного режима."""
+    frames = [it["image"].convert("RGB") for it in items if it.get("image") is not None]
+    if not frames:
+        return None
+    # Свой временный файл у каждого сборщика: упаковка после OCR и ensure_packed у выгрузки могут идти одновременно.
+    tmp = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        if BITRIX_EXPORT_MODE == "pdf":
+            _pdf(frames, tmp)
+        else:
+            _contact_sheet(frames, tmp)
+        # Переименование атомарно: выгрузка не увидит недописанный файл.
+        os.replace(tmp, out_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    print(f"🗜 [PACK] {len(frames)} стр. → {out_path} ({os.path.getsize(out_path) // 1024} КБ)", flush=True)
+    return out_path
+
+
+def pack_items(doc_id, items: List[Dict[str, Any]], page_paths: List[str]) -> Optional[str]:
+    """При OCR: упаковывает отобранные страницы из кадров, которые уже в памяти."""
+    by_path = {it["path"]: it for it in items}
+    pages = [by_path[p] for p in page_paths if p in by_path]
+    return pack(pages, packed_path(doc_id)) if pages else None
+
+
+def ensure_packed(doc_id, page_paths: List[str]) -> Optional[str]:
+    """При выгрузке: готовый файл документа или, если его нет (воркер перезапускался), собранный заново с диска."""
+    out_path = packed_path(doc_id)
+    if os.path.exists(out_path):
+        return out_path
+    items = [image_stage.load(p) for p in page_paths if p and os.path.exists(p)]
+    return pack(items, out_path)
@@ -1,85 +1,334 @@
-import os, json, time, redis, requests
-from app.db import init_db, insert_received, update_ocr, get_doc, set_confirmed, set_bitrix_result
-from app.ocr import extract_batch
+import os, json, time, signal, threading, redis
+from concurrent.futures import ThreadPoolExecutor
+from app.db import insert_received, update_ocr, get_doc, pool_stats
+from app.ocr import extract_batch, item_metrics
 from app.formatting import format_for_driver
-from app.telegram_client import download_photo as tg_download, send_message as tg_send
-from app.max_client import download_photo as max_download, send_message as max_send, HEADERS as MAX_HEADERS, MAX_API_URL
-from app.bitrix_client import send_to_bitrix_sync
+from app.telegram_client import download_photo as tg_download, send_message as tg_send, edit_message as tg_edit
+from app.max_client import download_photo as max_download, send_message as max_send, edit_message as max_edit
+from app.config import DOWNLOAD_CONCURRENCY
+from app import images as image_stage
+from app import metrics, task_queue, migrations, bitrix_export, waybill_pack, platform_http
 
-def main():
-    init_db()
-    rds = redis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
-    print("✅ Worker started. Logic: Mandatory Fields + Bitrix.", flush=True)
-    
-    while True:
+# Количество параллельных слотов: каждый слот сам забирает задачу из очереди и выполняет её целиком.
+WORKER_CONCURRENCY = max(1, int(os.getenv("WORKER_CONCURRENCY", "4")))
+POP_TIMEOUT = int(os.getenv("WORKER_POP_TIMEOUT", "5"))
+RECLAIM_INTERVAL = float(os.getenv("WORKER_RECLAIM_INTERVAL", "30"))
+# Как часто продлевать сообщение в работе, чтобы его не забрал reclaim другого слота.
+HEARTBEAT_INTERVAL = task_queue.CLAIM_IDLE_MS / 3000.0
+# Зарезервированные слоты только для быстрой полосы (экспорт в Битрикс):
+# подтверждение водителя не должно ждать, пока все слоты заняты OCR.
+WORKER_FAST_SLOTS = max(0, int(os.getenv("WORKER_FAST_SLOTS", "1")))
+# Не чаще одного промежуточного редактирования сообщения за это время (лимиты Telegram/MAX).
+PROGRESS_EDIT_INTERVAL = float(os.getenv("OCR_PROGRESS_EDIT_INTERVAL", "1.5"))
+PROGRESS_LABELS = [
+    ("loading_date", "value", "Дата погрузки"),
+    ("sender_address", "value", "Грузоотправитель"),
+    ("driver_name", "value", "ФИО водителя"),
+    ("weight_total", "kg", "Вес продукции, кг"),
+    ("product_type", "value", "Вид продукции"),
+]
+
+STOP = threading.Event()
+
+
+def _notify_export(platform, chat_id, mid, text):
+    if platform == "max":
+        if not (mid and max_edit(mid, text)):
+            max_send(chat_id, text)
+        return
+    if not (mid and tg_edit(chat_id, int(mid), text)):
+        tg_send(chat_id, text)
+
+
+def handle_bitrix_export(task):
+    doc_id = task["doc_id"]
+    export_id = task.get("export_id")
+
+    if export_id is None:
+        # Нажатие "Подтвердить": заводим (или возобновляем) выгрузку документа в outbox.
+        doc = get_doc(doc_id)
+        if not doc: return
+        ocr = doc.get("ocr_data") or {}
+        msg_text = format_for_driver(doc_id, ocr, True, "", 1.0, doc.get("operation_events"))
+        raw_paths = doc.get("photo_path")
+        photo_paths = raw_paths.split(",") if raw_paths else []
+        if waybill_pack.enabled():
+            # Одна загрузка на накладную: отобранные для OCR страницы одним PDF или сеткой.
+            packed = waybill_pack.ensure_packed(doc_id, ocr.get("ocr_pages") or photo_paths)
+            if packed:
+                photo_paths = [packed]
+        export = bitrix_export.create(doc_id, msg_text, photo_paths, task.get("platform", "telegram"), task.get("chat_id"), task.get("mid"))
+        if export["state"] == "done":
+            _notify_export(export["platform"], export["chat_id"], export["mid"], "✅ Уже отправлено в Битрикс24\n\n" + export["text"])
+            return
+        mid = task.get("mid")
+        if export["state"] == "in_progress" and mid is not None and str(mid) != str(export["mid"]):
+            # Выгрузку уже ведёт другая попытка, результат придёт в её сообщение — эту карточку не оставляем на "Отправляю...".
+            _notify_export(task.get("platform", "telegram"), task.get("chat_id"), mid, "⏳ Отправка в Битрикс24 уже идёт, результат появится в предыдущем сообщении.\n\n" + export["text"])
+        export_id = export["id"]
+
+    result = bitrix_export.run(export_id)
+    if result is None:
+        return
+    export, ok, err = result
+    if ok:
+        final_text = "✅ **Успешно отправлено в Битрикс24**\n\n" + export["text"]
+    elif export["state"] == "retry":
+        final_text = f"⏳ Битрикс24 не ответил ({err}). Отправка повторится автоматически.\n\n" + export["text"]
+    else:
+        final_text = "❌ Ошибка отправки: " + str(err) + "\n\n" + export["text"]
+    _notify_export(export["platform"], export["chat_id"], export["mid"], final_text)
+
+
+def _timed_download(download, platform, fid):
+    # Скачивание и единственное декодирование фото выполняются в одном потоке пула.
+    started = time.monotonic()
+    try:
+        path, raw = download(fid)
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.observe(f"download.{platform}.seconds", elapsed)
+        print(f"📥 [DOWNLOAD] {platform} {str(fid)[-24:]} за {elapsed:.2f}s", flush=True)
+    started = time.monotonic()
+    try:
+        item = image_stage.load(path, raw)
+    except Exception as e:
+        print(f"⚠️ [IMAGE] Не удалось декодировать {path}: {e}", flush=True)
+        return image_stage.failed(path)
+    finally:
+        metrics.observe("image.decode_seconds", time.monotonic() - started)
+    # Метрики документа считаем здесь же: фото альбома обрабатываются параллельно,
+    # а фильтры/гистограммы PIL работают в C без GIL.
+    started = time.monotonic()
+    try:
+        item_metrics(item)
+    except Exception as e:
+        print(f"⚠️ [IMAGE] Не удалось посчитать метрики {path}: {e}", flush=True)
+    metrics.observe("image.metrics_seconds", time.monotonic() - started)
+    return item
+
+
+def download_all(platform, files):
+    # Фото альбома качаем параллельно (ограниченно), порядок совпадает с порядком files.
+    download = max_download if platform == "max" else tg_download
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(len(files), DOWNLOAD_CONCURRENCY))) as pool:
+        items = list(pool.map(lambda fid: _timed_download(download, platform, fid), files))
+    metrics.observe(f"download.{platform}.batch_seconds", time.monotonic() - started)
+    return items
+
+
+def _progress_text(fields):
+    lines = ["🧠 Распознаю накладную...", ""]
+    for field, key, label in PROGRESS_LABELS:
+        val = (fields.get(field) or {}).get(key) if isinstance(fields.get(field), dict) else None
+        lines.append(f"{label}: {val if val not in (None, '') else '⏳'}")
+    return "\n".join(lines)
+
+
+def progress_reporter(platform, chat_id, ack_mid=None):
+    """Колбэк для потокового OCR: сообщение-подтверждение приёма (ack_mid) редактируется по мере прихода полей."""
+    state = {"mid": ack_mid, "last": 0.0, "shown": 0}
+
+    def on_fields(fields):
+        shown = sum(1 for field, _, _ in PROGRESS_LABELS if field in fields)
+        if shown == state["shown"] or time.monotonic() - state["last"] < PROGRESS_EDIT_INTERVAL:
+            return
+        state["shown"], state["last"] = shown, time.monotonic()
+        text = _progress_text(fields)
+        if state["mid"] is not None:
+            edited = max_edit(state["mid"], text) if platform == "max" else tg_edit(chat_id, state["mid"], text)
+            if edited:
+                return
+        # Подтверждения нет (не отправилось или уже удалено) — заводим своё сообщение прогресса.
+        mid = max_send(chat_id, text) if platform == "max" else tg_send(chat_id, text)
+        state["mid"] = mid if mid is not True else None
+
+    return on_fields, state
+
+
+def handle_batch(task):
+    platform = task.get("platform", "telegram")
+    chat_id = task.get("chat_id")
+    files = task.get("files", [])
+    if not files: return
+
+    items = download_all(platform, files)
+    paths = [it["path"] for it in items]
+
+    on_fields, progress = progress_reporter(platform, chat_id, task.get("ack_mid"))
+    data = extract_batch(items, chat_id=chat_id, on_fields=on_fields)
+
+    # Сохраняем оригинальные подсказки от OCR отдельно, чтобы в меню были только варианты от OpenAI.
+    data["ai_suggestions"] = {
+        "carrier_name": (data.get("carrier_name") or {}).get("value"),
+        "unloading_address": (data.get("unloading_address") or {}).get("value"),
+    }
+
+    # До подтверждения водителем обязательные поля не считаются заполненными.
+    data["carrier_name"] = {"value": None}
+    data["unloading_address"] = {"value": None}
+    data["operation_type"] = {"value": None}
+
+    # Повтор той же задачи (ретрай после сбоя, перехват у упавшего воркера) продолжает её документ.
+    doc_id, fresh = insert_received(chat_id, ",".join(files), ",".join(paths), task.get("task_id"))
+    if not fresh:
+        metrics.incr("batch.replayed")
+        print(f"♻️ [WORKER] Задача {task.get('task_id')} уже создала документ {doc_id}, обновляем его", flush=True)
+    update_ocr(doc_id, data, json.dumps(data), data.get("confidence", 0), "ocr_ok", "")
+
+    msg = format_for_driver(doc_id, data, True, "", data.get("confidence", 0))
+
+    # ОБНОВЛЕННАЯ КЛАВИАТУРА ПРИ ПЕРВОМ ОТВЕТЕ
+    kb = {"inline_keyboard": [
+        [{"text": "🔄 Статус / Операция", "callback_data": f"menu_op:{doc_id}"}],
+        [{"text": "📍 Локация выгрузки", "callback_data": f"menu_unload:{doc_id}"}],
+        [{"text": "🚚 Перевозчик", "callback_data": f"menu_carrier:{doc_id}"}],
+        [{"text": "✅ Подтвердить", "callback_data": f"ok:{doc_id}"}],
+        [{"text": "✏️ Исправить", "callback_data": f"edit:{doc_id}"}]
+    ]}
+
+    # Подтверждение приёма (или сообщение прогресса) заменяем итоговой карточкой с клавиатурой.
+    mid = progress["mid"]
+    if platform == "max":
+        if not (mid and max_edit(mid, msg, reply_markup=kb)): max_send(chat_id, msg, reply_markup=kb)
+    else:
+        if not (mid and tg_edit(chat_id, mid, msg, reply_markup=kb)): tg_send(chat_id, msg, reply_markup=kb)
+
+    if waybill_pack.enabled():
+        # Кадры ещё в памяти после OCR — собираем файл для Битрикса сейчас, а не при подтверждении.
+        try:
+            waybill_pack.pack_items(doc_id, items, data.get("ocr_pages") or paths)
+        except Exception as e:
+            print(f"⚠️ [PACK] Документ {doc_id}: {e}", flush=True)
+
+
+def process_task(task):
+    if task.get("type", "batch") == "bitrix_export":
+        handle_bitrix_export(task)
+    else:
+        handle_batch(task)
+
+
+def _heartbeat(rds, stream, msg_id, consumer):
+    """Фоновое продление сообщения, пока задача выполняется; остановка — set() у возвращённого Event."""
+    done = threading.Event()
+
+    def run():
+        while not done.wait(HEARTBEAT_INTERVAL):
+            try:
+                task_queue.touch(rds, stream, msg_id, consumer)
+            except Exception as e:
+                print(f"⚠️ [WORKER] Не удалось продлить {msg_id}: {e}", flush=True)
+
+    threading.Thread(target=run, name=f"heartbeat-{msg_id}", daemon=True).start()
+    return done
+
+
+def slot_loop(slot, rds, lanes):
+    name = f"slot.{slot}"
+    consumer = f"{metrics.WORKER_ID}-{slot}"
+    metrics.gauge(f"{name}.busy", 0)
+    next_reclaim = 0.0
+    while not STOP.is_set():
         try:
-            item = rds.blpop("tasks", timeout=10)
-            if not item: continue
-            
-            task = json.loads(item[1])
-            task_type = task.get("type", "batch")
-            platform = task.get("platform", "telegram")
-            chat_id = task.get("chat_id")
-
-            if task_type == "bitrix_export":
-                doc_id = task["doc_id"]
-                mid = task.get("mid")
-                
-                doc = get_doc(doc_id)
-                if not doc: continue
-                ocr = doc.get("ocr_data") or {}
-                msg_text = format_for_driver(doc_id, ocr, True, "", 1.0)
-                raw_paths = doc.get("photo_path")
-                photo_paths = raw_paths.split(",") if raw_paths else []
-
-                ok, resp, err, payload = send_to_bitrix_sync(text=msg_text, photo_paths=photo_paths)
-                final_text = ("✅ **Успешно отправлено в Битрикс24**\n\n" + msg_text) if ok else ("❌ Ошибка отправки: " + str(err) + "\n\n" + msg_text)
-
-                if platform == "max" and mid:
-                    requests.put(f"{MAX_API_URL}/messages", params={"message_id": mid}, json={"text": final_text}, headers=MAX_HEADERS)
-                elif platform == "max": max_send(chat_id, final_text)
-                else: tg_send(chat_id, final_text)
-                continue
-
-            files = task.get("files", [])
-            if not files: continue
-
-            if platform == "max": paths = [max_download(fid) for fid in files]
-            else: paths = [tg_download(fid) for fid in files]
-            
-            data = extract_batch(paths)
-
-            # Сохраняем оригинальные подсказки от OCR отдельно, чтобы в меню были только варианты от OpenAI.
-            data["ai_suggestions"] = {
-                "carrier_name": (data.get("carrier_name") or {}).get("value"),
-                "unloading_address": (data.get("unloading_address") or {}).get("value"),
-            }
-
-            # До подтверждения водителем обязательные поля не считаются заполненными.
-            data["carrier_name"] = {"value": None}
-            data["unloading_address"] = {"value": None}
-            data["operation_type"] = {"value": None}
-
-            doc_id = insert_received(chat_id, ",".join(files), ",".join(paths))
-            update_ocr(doc_id, data, json.dumps(data), data.get("confidence", 0), "ocr_ok", "")
-            
-            msg = format_for_driver(doc_id, data, True, "", data.get("confidence", 0))
-            
-            # ОБНОВЛЕННАЯ КЛАВИАТУРА ПРИ ПЕРВОМ ОТВЕТЕ
-            kb = {"inline_keyboard": [
-                [{"text": "🔄 Статус / Операция", "callback_data": f"menu_op:{doc_id}"}],
-                [{"text": "📍 Локация выгрузки", "callback_data": f"menu_unload:{doc_id}"}],
-                [{"text": "🚚 Перевозчик", "callback_data": f"menu_carrier:{doc_id}"}],
-                [{"text": "✅ Подтвердить", "callback_data": f"ok:{doc_id}"}],
-                [{"text": "✏️ Исправить", "callback_data": f"edit:{doc_id}"}]
-            ]}
-            
-            if platform == "max": max_send(chat_id, msg, reply_markup=kb)
-            else: tg_send(chat_id, msg, reply_markup=kb)
-            
+            messages = []
+            if time.monotonic() >= next_reclaim:
+                next_reclaim = time.monotonic() + RECLAIM_INTERVAL
+                messages = task_queue.reclaim(rds, consumer, lanes)
+            if not messages:
+                messages = task_queue.read(rds, consumer, POP_TIMEOUT * 1000, lanes)
         except Exception as e:
-            print(f"❌ [WORKER] ОШИБКА: {e}", flush=True)
+            print(f"❌ [WORKER {slot}] Ошибка чтения очереди: {e}", flush=True)
             time.sleep(1)
+            continue
+
+        # Блокирующее чтение по двум полосам может вернуть по сообщению из каждой: продлеваем все сразу,
+        # иначе второе, ожидая своей очереди за долгой первой задачей, заберёт reclaim другого слота.
+        beats = {msg_id: _heartbeat(rds, stream, msg_id, consumer) for stream, msg_id, _ in messages}
+        for stream, msg_id, fields in messages:
+            started = time.monotonic()
+            started_wall = time.time()
+            task_type = "?"
+            metrics.gauge(f"{name}.busy", 1)
+            beat = beats[msg_id]
+            try:
+                task = task_queue.decode(fields)
+                task_type = task.get("type", "batch")
+                task["task_id"] = task_queue.task_id(msg_id, fields)
+                process_task(task)
+                task_queue.ack(rds, stream, msg_id)
+                metrics.incr(f"{name}.done")
+            except Exception as e:
+                metrics.incr(f"{name}.failed")
+                print(f"❌ [WORKER {slot}] ОШИБКА: {e}", flush=True)
+                try:
+                    if not task_queue.fail(rds, stream, msg_id, fields, e):
+                        metrics.incr("queue.dead_lettered")
+                except Exception as qe:
+                    # Не смогли записать ретрай — сообщение останется в pending и будет забрано по таймауту.
+                    print(f"❌ [WORKER {slot}] Не удалось запланировать повтор {msg_id}: {qe}", flush=True)
+            finally:
+                beat.set()
+                elapsed = time.monotonic() - started
+                metrics.gauge(f"{name}.busy", 0)
+                metrics.observe(f"{name}.task_seconds", elapsed)
+                metrics.observe(f"task.{task_type}.seconds", elapsed)
+                if fields.get("enqueued_at"):
+                    lane = "fast" if stream == task_queue.FAST_STREAM else "ocr"
+                    metrics.observe(f"lane.{lane}.wait_seconds", started_wall - float(fields["enqueued_at"]))
+                print(f"⏱ [WORKER {slot}] {task_type} за {elapsed:.2f}s", flush=True)
+
+
+def housekeeping_loop(rds):
+    # Возвращаем в стрим задачи, у которых подошло время повтора, и обновляем глубину очередей.
+    while not STOP.wait(1):
+        try:
+            task_queue.promote_due(rds)
+            for k, v in task_queue.depth(rds).items():
+                metrics.gauge(f"queue.{k}", v)
+            for k, v in pool_stats().items():
+                metrics.gauge(f"db.pool.{k}", v)
+            for endpoint, st in platform_http.stats().items():
+                # "telegram POST /sendMessage" → http.telegram.POST.sendMessage
+                name = "http." + ".".join(part for part in endpoint.replace("/", " ").split() if part)
+                metrics.gauge(f"{name}.count", st["count"])
+                if st["p95"] is not None:
+                    metrics.gauge(f"{name}.p95", st["p95"])
+            bitrix_export.drain(rds)
+        except Exception as e:
+            print(f"⚠️ [WORKER] Ошибка обслуживания очереди: {e}", flush=True)
+
+
+def _request_stop(signum, frame):
+    print(f"🛑 [WORKER] Получен сигнал {signum}, дожидаемся текущих задач...", flush=True)
+    STOP.set()
+
+
+def main():
+    migrations.check_schema()
+    rds = redis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+    task_queue.ensure_group(rds)
+    task_queue.migrate_legacy_list(rds)
+
+    slots = []
+    for i in range(WORKER_CONCURRENCY + WORKER_FAST_SLOTS):
+        lanes = ("fast", "ocr") if i < WORKER_CONCURRENCY else ("fast",)
+        t = threading.Thread(target=slot_loop, args=(i, rds, lanes), name=f"worker-slot-{i}", daemon=True)
+        t.start()
+        slots.append(t)
+    threading.Thread(target=housekeeping_loop, args=(rds,), name="queue-housekeeping", daemon=True).start()
+    reporter = metrics.start_reporter(rds, STOP)
+    print(f"✅ Worker started. Logic: Mandatory Fields + Bitrix. Slots: {WORKER_CONCURRENCY} + fast: {WORKER_FAST_SLOTS}", flush=True)
+
+    while not STOP.wait(1):
+        pass
+    for t in slots:
+        t.join()
+    reporter.join(timeout=5)
+    print("👋 [WORKER] Остановлен.", flush=True)
 
 if __name__ == "__main__":
     main()